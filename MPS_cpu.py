@@ -1,6 +1,6 @@
 import numpy as np
 from scipy.special import factorial
-from scipy.linalg import sqrtm, svd, block_diag, schur
+from symplectic import cached_williamson, cached_blochmessiah, get_cache_dir
 import argparse
 import time
 
@@ -13,6 +13,7 @@ args = vars(parser.parse_args())
 d = args['d']
 chi = args['chi']
 rootdir = args['dir']
+cache_dir = get_cache_dir(rootdir)
 
 complex_type = 'complex64'
 
@@ -46,74 +47,6 @@ def push_to_end(array):
         new_array[np.arange(n_batch), -idx] = array[:, -i]
     return new_array
 
-def sympmat(N, dtype=np.float64):
-    I = np.identity(N, dtype=dtype)
-    O = np.zeros_like(I, dtype=dtype)
-    S = np.block([[O, I], [-I, O]])
-    return S
-
-def xpxp_to_xxpp(S):
-    shape = S.shape
-    n = shape[0]
-
-    if n % 2 != 0:
-        raise ValueError("The input array is not even-dimensional")
-
-    n = n // 2
-    ind = np.arange(2 * n).reshape(-1, 2).T.flatten()
-
-    if len(shape) == 2:
-        if shape[0] != shape[1]:
-            raise ValueError("The input matrix is not square")
-        return S[:, ind][ind]
-
-    return S[ind]
-
-def williamson(V, tol=1e-11):
-    (n, m) = V.shape
-
-    if n != m:
-        raise ValueError("The input matrix is not square")
-
-    diffn = np.linalg.norm(V - np.transpose(V))
-
-    if diffn >= tol:
-        raise ValueError("The input matrix is not symmetric")
-
-    if n % 2 != 0:
-        raise ValueError("The input matrix must have an even number of rows/columns")
-
-    n = n // 2
-    omega = sympmat(n)
-    vals = np.linalg.eigvalsh(V)
-
-    for val in vals:
-        if val <= 0:
-            raise ValueError("Input matrix is not positive definite")
-
-    Mm12 = sqrtm(np.linalg.inv(V)).real
-    r1 = Mm12 @ omega @ Mm12
-    s1, K = schur(r1)
-    X = np.array([[0, 1], [1, 0]])
-    I = np.identity(2)
-    seq = []
-
-    for i in range(n):
-        if s1[2 * i, 2 * i + 1] > 0:
-            seq.append(I)
-        else:
-            seq.append(X)
-
-    p = block_diag(*seq)
-    Kt = K @ p
-    s1t = p @ s1 @ p
-    dd = xpxp_to_xxpp(s1t)
-    perm_indices = xpxp_to_xxpp(np.arange(2 * n))
-    Ktt = Kt[:, perm_indices]
-    Db = np.diag([1 / dd[i, i + n] for i in range(n)] + [1 / dd[i, i + n] for i in range(n)])
-    S = Mm12 @ Ktt @ sqrtm(Db)
-    return Db, np.linalg.inv(S).T
-
 def hafnian(A): 
 
     matshape = A.shape[1:]
@@ -186,48 +119,6 @@ def solve(b, s, w, g, n):  # pragma: no cover
                     )
     return h + solve(c, s - 2, w, e, n)
 
-def blochmessiah(S):
-    N, _ = S.shape
-
-    # Changing Basis
-    R = (1 / np.sqrt(2)) * np.block(
-        [[np.eye(N // 2), 1j * np.eye(N // 2)], [np.eye(N // 2), -1j * np.eye(N // 2)]]
-    )
-    Sc = R @ S @ np.conjugate(R).T
-    # Polar Decomposition
-    # u1, d1, v1 = np.linalg.svd(Sc)
-    u1, d1, v1 = svd(Sc, lapack_driver='gesvd')
-    Sig = u1 @ np.diag(d1) @ np.conjugate(u1).T
-    Unitary = u1 @ v1
-    # Blocks of Unitary and Hermitian symplectics
-    alpha = Unitary[0 : N // 2, 0 : N // 2]
-    beta = Sig[0 : N // 2, N // 2 : N]
-    # Bloch-Messiah in this Basis
-    u2, d2, v2 = np.linalg.svd(beta)
-    sval = np.arcsinh(d2)
-    takagibeta = u2 @ sqrtm(np.conjugate(u2).T @ (v2.T))
-    uf = np.block([[takagibeta, 0 * takagibeta], [0 * takagibeta, np.conjugate(takagibeta)]])
-    vf = np.block(
-        [
-            [np.conjugate(takagibeta).T @ alpha, 0 * takagibeta],
-            [0 * takagibeta, np.conjugate(np.conjugate(takagibeta).T @ alpha)],
-        ]
-    )
-    df = np.block(
-        [
-            [np.diag(np.cosh(sval)), np.diag(np.sinh(sval))],
-            [np.diag(np.sinh(sval)), np.diag(np.cosh(sval))],
-        ]
-    )
-    # Rotating Back to Original Basis
-    uff = np.conjugate(R).T @ uf @ R
-    vff = np.conjugate(R).T @ vf @ R
-    dff = np.conjugate(R).T @ df @ R
-    dff = np.real_if_close(dff)
-    vff = np.real_if_close(vff)
-    uff = np.real_if_close(uff)
-    return uff, dff, vff
-
 def thermal_photons(nth, cutoff = 20):
     return 1 / (nth + 1) * (nth / (nth + 1)) ** np.arange(cutoff)
 
@@ -250,13 +141,13 @@ def cartesian(array1, array2):
     # return np.array([np.append(a, b) for a in array1 for b in array2])
 
 
-def get_cumsum_kron(sq_cov, L, chi = 100, max_dim = 10 ** 5, cutoff = 6, err_tol = 10 ** (-12)):
+def get_cumsum_kron(sq_cov, L, chi = 100, max_dim = 10 ** 5, cutoff = 6, err_tol = 10 ** (-12), cache_dir = None):
     M = len(sq_cov) // 2
     mode = np.arange(L, M)
     modes = np.append(mode, mode + M)
     sq_cov_A = sq_cov[np.ix_(modes, modes)]
 
-    D, S = williamson(sq_cov_A)
+    D, S = cached_williamson(sq_cov_A, cache_dir)
     d = (np.diag(D) - 1) / 2
 
     d[d < 0] = 0
@@ -354,7 +245,7 @@ def A_elem(Sigma, target, denominator, max_memory_in_gb):
         all_haf = np.append(all_haf, haf)
     return all_haf / denominator, haf_time, sigma_time
 
-def get_U2_sq_U1(S_l, S_r):
+def get_U2_sq_U1(S_l, S_r, cache_dir = None):
     M = len(S_r) // 2
     mode = np.arange(M - 1) + 1
     modes = np.append(mode, mode + M)
@@ -363,7 +254,7 @@ def get_U2_sq_U1(S_l, S_r):
     S_l2_inv[np.ix_(modes, modes)] = np.linalg.inv(S_l)
     S = S_l2_inv @ S_r
     
-    S2, SQ, S1 = blochmessiah(S)
+    S2, SQ, S1 = cached_blochmessiah(S, cache_dir)
     U2 = S2[:M, :M] - 1j * S2[:M, M:]
     U1 = S1[:M, :M] - 1j * S1[:M, M:]
 
@@ -381,6 +272,10 @@ if __name__ == "__main__":
     cov = np.load(rootdir + "cov.npy")
     M = len(cov) // 2
 
+    # Symplectic matrix of the full squeezed covariance. Every site starts from it as S_r, which the first site
+    # uses directly; the other sites replace it by the symplectic of their left cut. Computed once (and cached).
+    _, S_full = cached_williamson(sq_cov, cache_dir)
+
     for compute_site in range(M):
         print('mode: ', compute_site)
 
@@ -392,7 +287,7 @@ if __name__ == "__main__":
         tot_haf_time = 0
         tot_sigma_time = 0
 
-        _, S_r = williamson(sq_cov)
+        S_r = S_full
 
         Gamma = np.zeros([chi, chi, d], dtype='complex64')
         Lambda = np.zeros([chi], dtype='float32')
@@ -406,7 +301,7 @@ if __name__ == "__main__":
             S_l = np.load(path + f'S_{compute_site}.npy')
             num = num[res > err_tol]
             res = res[res > err_tol]
-            U2, sq, U1 = get_U2_sq_U1(S_l, S_r)
+            U2, sq, U1 = get_U2_sq_U1(S_l, S_r, cache_dir)
             Sigma = get_Sigma(U2, sq, U1)
             left_target = get_target(num)
             left_sum = np.sum(num, axis=1)
@@ -437,7 +332,7 @@ if __name__ == "__main__":
             right_denominator = np.sqrt(np.product(np.array(factorial(num_pre)), axis=1))
 
             S_l = np.zeros((0, 0))
-            U2, sq, U1 = get_U2_sq_U1(S_l, S_r)
+            U2, sq, U1 = get_U2_sq_U1(S_l, S_r, cache_dir)
             Z = np.sqrt(np.prod(np.cosh(sq)))
             Sigma = get_Sigma(U2, sq, U1)
 
@@ -478,7 +373,7 @@ if __name__ == "__main__":
             full_sum = np.repeat(left_sum.reshape(-1, 1), right_sum.shape[0], axis=1) + np.repeat(right_sum.reshape(1, -1), left_sum.shape[0], axis=0)
             left_denominator = np.sqrt(np.product(np.array(factorial(num)), axis=1))
             res = res[res > err_tol]
-            U2, sq, U1 = get_U2_sq_U1(S_l, S_r) # S_l: left in equation, S_r : right in equation
+            U2, sq, U1 = get_U2_sq_U1(S_l, S_r, cache_dir) # S_l: left in equation, S_r : right in equation
             Sigma = get_Sigma(U2, sq, U1)
             Z = np.sqrt(np.prod(np.cosh(sq)))
             Lambda[:len(res)] = np.array(np.sqrt(res))
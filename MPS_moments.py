@@ -0,0 +1,181 @@
+import numpy as np
+import argparse
+import time
+from sampling_utils import get_sqrtW, load_Lambda, load_Gammas, vacuum_displacement_rows, batch_mu_to_alpha
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--d', type=int, help='d of the MPS.')
+parser.add_argument('--chi', type=int, help='Bond dimension.')
+parser.add_argument('--dir', type=str, help="Root directory.", default=0)
+parser.add_argument('--clicks', action='store_true', help="Also compute click probabilities (d^2 instead of 3 environments per mode).")
+parser.add_argument('--L', type=int, help="Number of Monte Carlo displacements for the click probabilities.", default=10 ** 5)
+args = vars(parser.parse_args())
+
+# First and second order photon-number and click moments of the sampled model, the MPS state |psi> displaced by
+# the Gaussian random displacements alpha of sampling_cpu.py, without sampling. Photon-number moments are exact:
+# D(alpha)^dagger a D(alpha) = a + alpha, so they only need <n_i>, <n_i n_j>, <a_i a_j> and <a_i^dagger a_j> of
+# |psi> and the covariance of alpha. Click probabilities average the vacuum projector over alpha by Monte Carlo.
+
+# A_i = diag(Lambda_{i-1}) Gamma_i, with the left index of the first site summed over like in sampling.
+# The environment to the right of site i is diag(Lambda_i^2), and the first column for the last site.
+def site_tensors(Gammas, Lambda):
+    M = len(Gammas)
+    A = [np.sum(Gammas[0], axis=0)[np.newaxis]]
+    for i in range(1, M):
+        A.append(Lambda[:, i - 1, np.newaxis, np.newaxis] * Gammas[i])
+    right_weights = [Lambda[:, i] ** 2 for i in range(M - 1)]
+    right_weights.append(np.eye(A[-1].shape[1])[0])
+    return A, right_weights
+
+# X[k, b, c', t] = sum_c E[k, b, c] A[c, c', t]
+def ket_contract(E, A):
+    chi_left, chi_right, d = A.shape
+    return (E @ A.reshape(chi_left, chi_right * d)).reshape(-1, chi_left, chi_right, d)
+
+# Moves the environments E[k, bra, ket] over a site, applying ops[p] (bra x ket) to a single environment if given
+def transfer(E, A, ops=None):
+    chi_left, chi_right, d = A.shape
+    X = ket_contract(E, A)
+    if ops is not None:
+        X = X @ ops[:, np.newaxis].transpose(0, 1, 3, 2)
+    X = X.transpose(0, 2, 1, 3).reshape(-1, chi_right, chi_left * d)
+    A_bra = np.conj(A).transpose(1, 0, 2).reshape(chi_right, chi_left * d)
+    return (X @ A_bra.T).transpose(0, 2, 1)
+
+# C[k, s, t] such that <O_k X> = sum_st X[s, t] C[k, s, t] for an operator X (bra s, ket t) on this site
+def closure(E, A, right_weights):
+    chi_left, chi_right, d = A.shape
+    A_bra = (np.conj(A) * right_weights[np.newaxis, :, np.newaxis]).reshape(chi_left * chi_right, d)
+    return A_bra.T @ ket_contract(E, A).reshape(-1, chi_left * chi_right, d)
+
+# Single-site reduced density matrices rho[i] (M x d x d) and pairs[i, j, p] = C of the operator left_ops[p] on
+# site i and site j > i, in one left-to-right sweep per i starting from the cached left environments.
+# Costs O(M^2 len(left_ops) d chi^3).
+def reduced_density_matrices(Gammas, Lambda, left_ops):
+    A, right_weights = site_tensors(Gammas, Lambda)
+    M = len(A)
+    d = A[0].shape[2]
+    rho = np.zeros([M, d, d], dtype='complex128')
+    pairs = np.zeros([M, M, len(left_ops), d, d], dtype='complex128')
+    left_environments = [np.ones([1, 1, 1], dtype=A[0].dtype)]
+    for i in range(M):
+        rho[i] = closure(left_environments[i], A[i], right_weights[i])[0].T
+        left_environments.append(transfer(left_environments[i], A[i]))
+    norms = np.trace(rho, axis1=1, axis2=2).real # 1 for an MPS in canonical form
+    rho /= norms[:, np.newaxis, np.newaxis]
+    for i in range(M - 1):
+        E = transfer(left_environments[i], A[i], left_ops.astype(A[i].dtype))
+        for j in range(i + 1, M):
+            pairs[i, j] = closure(E, A[j], right_weights[j]) / norms[j]
+            if j < M - 1:
+                E = transfer(E, A[j])
+    return rho, pairs
+
+# E[alpha_i conj(alpha_j)] and E[alpha_i alpha_j] of alpha = (mu_x + i mu_p) / 2, mu ~ N(0, sqrtW sqrtW^T)
+def alpha_covariances(sqrtW):
+    M = len(sqrtW) // 2
+    W = sqrtW @ sqrtW.T
+    Wxx, Wxp, Wpx, Wpp = W[:M, :M], W[:M, M:], W[M:, :M], W[M:, M:]
+    w = (Wxx + Wpp + 1j * (Wpx - Wxp)) / 4
+    v = (Wxx - Wpp + 1j * (Wxp + Wpx)) / 4
+    return w, v
+
+def ladder_operators(d):
+    a = np.diag(np.sqrt(np.arange(1, d)), 1)
+    return np.array([np.diag(np.arange(d)), a, a.T]).astype('complex128') # n, a, a^dagger
+
+# <n_i> and <n_i n_j> (M x M, including <n_i^2> on the diagonal) of the displaced model
+def photon_number_moments(rho, pairs_nad, sqrtW):
+    M, d = rho.shape[:2]
+    n, a, ad = ladder_operators(d)
+    n1 = np.einsum('st,mts->m', n, rho).real
+    n2 = np.einsum('st,mts->m', n @ n, rho).real
+    a2 = np.einsum('st,mts->m', a @ a, rho)
+    nn = np.einsum('st,ijst->ij', n, pairs_nad[:, :, 0]).real
+    aa = np.einsum('st,ijst->ij', a, pairs_nad[:, :, 1])
+    ada = np.einsum('st,ijst->ij', a, pairs_nad[:, :, 2])
+    w, v = alpha_covariances(sqrtW)
+    w_diag = np.diag(w).real
+    v_diag = np.diag(v)
+
+    means = n1 + w_diag
+    # Gaussian average of (n_i + alpha_i^* a_i + alpha_i a_i^dagger + |alpha_i|^2)(n_j + ...), Isserlis for the fourth moments
+    second = (nn + np.outer(n1, w_diag) + np.outer(w_diag, n1) + np.outer(w_diag, w_diag) + np.abs(w) ** 2 + np.abs(v) ** 2
+              + 2 * np.real(np.conj(v) * aa + w * ada))
+    second = np.triu(second, 1)
+    second = second + second.T
+    second[np.diag_indices(M)] = n2 + 2 * np.real(np.conj(v_diag) * a2) + 4 * w_diag * n1 + w_diag + 2 * w_diag ** 2 + np.abs(v_diag) ** 2
+    return means, second
+
+# Click probabilities p_i and p_ij (M x M, p_i on the diagonal). The no-click projector of the displaced state is
+# the coherent state projector |-alpha><-alpha|, whose products over two modes are averaged over L displacements.
+def click_moments(rho, pairs_basis, sqrtW, L=10 ** 5, batch=10 ** 4, rng=None):
+    if rng is None:
+        rng = np.random.default_rng(0)
+    M, d = rho.shape[:2]
+    no_click = np.zeros(M)
+    no_click_pairs = np.zeros([M * d * d, M * d * d], dtype='complex128')
+    for begin in range(0, L, batch):
+        size = min(L, begin + batch) - begin
+        alpha = batch_mu_to_alpha((sqrtW @ rng.normal(size=(2 * M, size))).T, hbar=2)
+        r = vacuum_displacement_rows(d, alpha, dtype='complex128') # <0|D(alpha)|t> = conj(<t|-alpha>)
+        projectors = np.conj(r)[:, :, :, np.newaxis] * r[:, :, np.newaxis, :] # size x M x d x d
+        no_click += np.einsum('Bmst,mts->m', projectors, rho).real
+        projectors = projectors.reshape(size, M * d * d)
+        no_click_pairs += projectors.T @ projectors
+    no_click /= L
+    no_click_pairs = no_click_pairs.reshape(M, d * d, M, d * d).transpose(0, 2, 1, 3) / L
+    both_no_click = np.einsum('ijab,ijab->ij', no_click_pairs, pairs_basis.reshape(M, M, d * d, d * d)).real
+    clicks = 1 - no_click[:, np.newaxis] - no_click[np.newaxis, :] + both_no_click
+    clicks = np.triu(clicks, 1)
+    clicks = clicks + clicks.T
+    clicks[np.diag_indices(M)] = 1 - no_click
+    return 1 - no_click, clicks
+
+def mps_moments(Gammas, Lambda, sqrtW, clicks=False, L=10 ** 5):
+    d = Gammas[0].shape[2]
+    results = {}
+    if clicks:
+        basis = np.eye(d * d).reshape(d * d, d, d)
+        rho, pairs_basis = reduced_density_matrices(Gammas, Lambda, basis)
+        M = len(rho)
+        pairs_nad = np.einsum('pkl,ijklst->ijpst', ladder_operators(d), pairs_basis.reshape(M, M, d, d, d, d))
+        results['click_means'], results['click_second_moments'] = click_moments(rho, pairs_basis, sqrtW, L)
+    else:
+        rho, pairs_nad = reduced_density_matrices(Gammas, Lambda, ladder_operators(d))
+    results['means'], results['second_moments'] = photon_number_moments(rho, pairs_nad, sqrtW)
+    return results
+
+# Mean photon numbers and photon-number covariances of the ideal Gaussian state (hbar = 2, zero displacement)
+def ideal_photon_number_moments(cov):
+    M = len(cov) // 2
+    means = (np.diag(cov)[:M] + np.diag(cov)[M:]) / 4 - 1 / 2
+    covariances = (cov[:M, :M] ** 2 + cov[:M, M:] ** 2 + cov[M:, :M] ** 2 + cov[M:, M:] ** 2) / 8
+    return means, covariances
+
+
+if __name__ == "__main__":
+
+    d = args['d']
+    chi = args['chi']
+    rootdir = args['dir']
+    path = rootdir + f'd_{d}_chi_{chi}/'
+    cov = np.load(rootdir + "cov.npy")
+    sqrtW = get_sqrtW(cov, np.load(rootdir + "sq_cov.npy"))
+    M = len(cov) // 2
+    Gammas = load_Gammas(path, M)
+    Lambda = load_Lambda(path, chi, M)
+
+    start = time.time()
+    results = mps_moments(Gammas, Lambda, sqrtW, args['clicks'], args['L'])
+    print('Moments computed in {:.2f} s.'.format(time.time() - start))
+    np.savez(rootdir + f'moments_d_{d}_chi_{chi}.npz', **results)
+
+    means, covariances = results['means'], results['second_moments'] - np.outer(results['means'], results['means'])
+    ideal_means, ideal_covariances = ideal_photon_number_moments(cov)
+    upper = np.triu_indices(M, 1)
+    print('First order: max deviation from ideal {:.3e}, Pearson correlation {:.6f}.'.format(
+        np.abs(means - ideal_means).max(), np.corrcoef(means, ideal_means)[0, 1]))
+    print('Second order: max deviation from ideal {:.3e}, Pearson correlation {:.6f}, two-norm of difference {:.3e}.'.format(
+        np.abs(covariances - ideal_covariances)[upper].max(), np.corrcoef(covariances[upper], ideal_covariances[upper])[0, 1],
+        np.linalg.norm(covariances[upper] - ideal_covariances[upper])))
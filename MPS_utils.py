@@ -1,7 +1,7 @@
 import numpy as np
-import cupy as cp
 from tqdm import tqdm
-from scipy.linalg import sqrtm, svd, block_diag, schur
+from symplectic import cached_blochmessiah
+from array_backend import get_array_module, synchronize
 from math import ceil
 import time
 
@@ -12,19 +12,42 @@ tqdm = nothing_function
 
 complex_type = 'complex64'
 
-kernel_file = open('direct_mps_kernels.cu')
-kernel_string = kernel_file.read()
-kernel_file.close()
-sigma_select_cfloat = cp.RawKernel(kernel_string, 'sigma_select_cfloat')
-sigma_select_cdouble = cp.RawKernel(kernel_string, 'sigma_select_cdouble')
+# Array module of the functions below, set with set_backend. The CUDA kernels are only compiled for cupy.
+xp = np
+sigma_select_cfloat = None
+sigma_select_cdouble = None
+
+def set_backend(backend, device=None):
+    global xp, sigma_select_cfloat, sigma_select_cdouble
+    xp = get_array_module(backend, device)
+    if xp is not np and sigma_select_cfloat is None:
+        kernel_file = open('direct_mps_kernels.cu')
+        kernel_string = kernel_file.read()
+        kernel_file.close()
+        sigma_select_cfloat = xp.RawKernel(kernel_string, 'sigma_select_cfloat')
+        sigma_select_cdouble = xp.RawKernel(kernel_string, 'sigma_select_cdouble')
+    return xp
+
+# Sigma2[b] = Sigma[target[b]][:, target[b]], gathered in batches of batch_size
+def Sigma_select_cpu(Sigma, target, batch_size=65535):
+    n_batch, n_select = target.shape
+    Sigma = np.asarray(Sigma, dtype=complex_type)
+    target = np.asarray(target)
+    Sigma2 = np.zeros([n_batch, n_select, n_select], dtype=complex_type)
+    for begin in range(0, n_batch, batch_size):
+        batch_target = target[begin : begin + batch_size]
+        Sigma2[begin : begin + batch_size] = Sigma[batch_target[:, :, np.newaxis], batch_target[:, np.newaxis, :]]
+    return Sigma2
 
 def Sigma_select(Sigma, target):
+    if xp is np:
+        return Sigma_select_cpu(Sigma, target)
     max_blocks = 65535
     n_batch, n_select = target.shape
     n_len = Sigma.shape[0]
-    target = cp.array(target, dtype='int32')
-    Sigma = cp.array(Sigma, dtype=complex_type)
-    Sigma2 = cp.zeros([n_batch, n_select, n_select], dtype=complex_type)
+    target = xp.array(target, dtype='int32')
+    Sigma = xp.array(Sigma, dtype=complex_type)
+    Sigma2 = xp.zeros([n_batch, n_select, n_select], dtype=complex_type)
     threadsperblock = (4, 4, 16)
     blockspergrid = (ceil(n_select/4), ceil(n_select/4), ceil(n_batch/16))
     if complex_type == 'complex64':
@@ -56,84 +79,16 @@ def push_to_end(array):
         new_array[np.arange(n_batch), -idx] = array[:, -i]
     return new_array
 
-def sympmat(N, dtype=np.float64):
-    I = np.identity(N, dtype=dtype)
-    O = np.zeros_like(I, dtype=dtype)
-    S = np.block([[O, I], [-I, O]])
-    return S
-
-def xpxp_to_xxpp(S):
-    shape = S.shape
-    n = shape[0]
-
-    if n % 2 != 0:
-        raise ValueError("The input array is not even-dimensional")
-
-    n = n // 2
-    ind = np.arange(2 * n).reshape(-1, 2).T.flatten()
-
-    if len(shape) == 2:
-        if shape[0] != shape[1]:
-            raise ValueError("The input matrix is not square")
-        return S[:, ind][ind]
-
-    return S[ind]
-
-def williamson(V, tol=1e-11):
-    (n, m) = V.shape
-
-    if n != m:
-        raise ValueError("The input matrix is not square")
-
-    diffn = np.linalg.norm(V - np.transpose(V))
-
-    if diffn >= tol:
-        raise ValueError("The input matrix is not symmetric")
-
-    if n % 2 != 0:
-        raise ValueError("The input matrix must have an even number of rows/columns")
-
-    n = n // 2
-    omega = sympmat(n)
-    vals = np.linalg.eigvalsh(V)
-
-    for val in vals:
-        if val <= 0:
-            raise ValueError("Input matrix is not positive definite")
-
-    Mm12 = sqrtm(np.linalg.inv(V)).real
-    r1 = Mm12 @ omega @ Mm12
-    s1, K = schur(r1)
-    X = np.array([[0, 1], [1, 0]])
-    I = np.identity(2)
-    seq = []
-
-    for i in range(n):
-        if s1[2 * i, 2 * i + 1] > 0:
-            seq.append(I)
-        else:
-            seq.append(X)
-
-    p = block_diag(*seq)
-    Kt = K @ p
-    s1t = p @ s1 @ p
-    dd = xpxp_to_xxpp(s1t)
-    perm_indices = xpxp_to_xxpp(np.arange(2 * n))
-    Ktt = Kt[:, perm_indices]
-    Db = np.diag([1 / dd[i, i + n] for i in range(n)] + [1 / dd[i, i + n] for i in range(n)])
-    S = Mm12 @ Ktt @ sqrtm(Db)
-    return Db, np.linalg.inv(S).T
-
 def hafnian(A): 
 
     matshape = A.shape[1:]
     n_batch = A.shape[0]
 
     if matshape == (0, 0):
-        return cp.ones(n_batch, dtype='complex64')
+        return xp.ones(n_batch, dtype='complex64')
     
     if matshape[0] % 2 != 0:
-        return cp.zeros(n_batch, dtype='complex64')
+        return xp.zeros(n_batch, dtype='complex64')
     
     '''removed case where it is identity'''
     if matshape[0] == 2:
@@ -160,12 +115,12 @@ def recursive_hafnian(A):  # pragma: no cover
         raise ValueError("Matrix size must be even")
 
     n = A.shape[1] // 2
-    z = cp.zeros((n_batch, n * (2 * n - 1), n + 1), dtype=A.dtype)
+    z = xp.zeros((n_batch, n * (2 * n - 1), n + 1), dtype=A.dtype)
     for j in range(1, 2 * n):
         ind = j * (j - 1) // 2
         for k in range(j):
             z[:, ind + k, 0] = A[:, j, k]
-    g = cp.zeros([n_batch, n + 1], dtype=A.dtype)
+    g = xp.zeros([n_batch, n + 1], dtype=A.dtype)
     g[:, 0] = 1
     return solve(z, 2 * n, 1, g, n)
 
@@ -175,7 +130,7 @@ def solve(b, s, w, g, n):  # pragma: no cover
     n_batch = b.shape[0]
     if s == 0:
         return w * g[:, n]
-    c = cp.zeros((n_batch, (s - 2) * (s - 3) // 2, n + 1), dtype=g.dtype)
+    c = xp.zeros((n_batch, (s - 2) * (s - 3) // 2, n + 1), dtype=g.dtype)
     i = 0
     for j in range(1, s - 2):
         for k in range(j):
@@ -196,48 +151,6 @@ def solve(b, s, w, g, n):  # pragma: no cover
                     )
     return h + solve(c, s - 2, w, e, n)
 
-def blochmessiah(S):
-    N, _ = S.shape
-
-    # Changing Basis
-    R = (1 / np.sqrt(2)) * np.block(
-        [[np.eye(N // 2), 1j * np.eye(N // 2)], [np.eye(N // 2), -1j * np.eye(N // 2)]]
-    )
-    Sc = R @ S @ np.conjugate(R).T
-    # Polar Decomposition
-    # u1, d1, v1 = np.linalg.svd(Sc)
-    u1, d1, v1 = svd(Sc, lapack_driver='gesvd')
-    Sig = u1 @ np.diag(d1) @ np.conjugate(u1).T
-    Unitary = u1 @ v1
-    # Blocks of Unitary and Hermitian symplectics
-    alpha = Unitary[0 : N // 2, 0 : N // 2]
-    beta = Sig[0 : N // 2, N // 2 : N]
-    # Bloch-Messiah in this Basis
-    u2, d2, v2 = np.linalg.svd(beta)
-    sval = np.arcsinh(d2)
-    takagibeta = u2 @ sqrtm(np.conjugate(u2).T @ (v2.T))
-    uf = np.block([[takagibeta, 0 * takagibeta], [0 * takagibeta, np.conjugate(takagibeta)]])
-    vf = np.block(
-        [
-            [np.conjugate(takagibeta).T @ alpha, 0 * takagibeta],
-            [0 * takagibeta, np.conjugate(np.conjugate(takagibeta).T @ alpha)],
-        ]
-    )
-    df = np.block(
-        [
-            [np.diag(np.cosh(sval)), np.diag(np.sinh(sval))],
-            [np.diag(np.sinh(sval)), np.diag(np.cosh(sval))],
-        ]
-    )
-    # Rotating Back to Original Basis
-    uff = np.conjugate(R).T @ uf @ R
-    vff = np.conjugate(R).T @ vf @ R
-    dff = np.conjugate(R).T @ df @ R
-    dff = np.real_if_close(dff)
-    vff = np.real_if_close(vff)
-    uff = np.real_if_close(uff)
-    return uff, dff, vff
-
 def thermal_photons(nth, cutoff = 20):
     return 1 / (nth + 1) * (nth / (nth + 1)) ** np.arange(cutoff)
 
@@ -268,12 +181,12 @@ def get_target(num):
         # print(mask)
         target += mask * (i + 1)
         idx_begin = np.copy(idx_end)
-    return cp.array(target, dtype='int32')
+    return xp.array(target, dtype='int32')
 
 def A_elem(Sigma, target, denominator, max_memory_in_gb):
     # print(target.shape)
     n_batch, n_select = target.shape
-    all_haf = cp.zeros([0], dtype='complex64')
+    all_haf = xp.zeros([0], dtype='complex64')
     if n_select == 0:
         n_batch_max = 99999999999
     else:
@@ -285,18 +198,18 @@ def A_elem(Sigma, target, denominator, max_memory_in_gb):
         end_batch = min(n_batch, begin_batch + n_batch_max)
         start = time.time()
         Sigma2 = Sigma_select(Sigma, target[begin_batch : end_batch])
-        cp.cuda.runtime.deviceSynchronize()
+        synchronize(xp)
         sigma_time += time.time() - start
         start = time.time()
         haf = hafnian(Sigma2).astype('complex64')
         # haf = cp.zeros([Sigma2.shape[0]], dtype='complex64')
-        cp.cuda.runtime.deviceSynchronize()
+        synchronize(xp)
         haf_time += time.time() - start
         # print(haf)
-        all_haf = cp.append(all_haf, haf)
+        all_haf = xp.append(all_haf, haf)
     return all_haf / denominator, haf_time, sigma_time
 
-def get_U2_sq_U1(S_l, S_r):
+def get_U2_sq_U1(S_l, S_r, cache_dir = None):
     M = len(S_r) // 2
     mode = np.arange(M - 1) + 1
     modes = np.append(mode, mode + M)
@@ -305,7 +218,7 @@ def get_U2_sq_U1(S_l, S_r):
     S_l2_inv[np.ix_(modes, modes)] = np.linalg.inv(S_l)
     S = S_l2_inv @ S_r
     
-    S2, SQ, S1 = blochmessiah(S)
+    S2, SQ, S1 = cached_blochmessiah(S, cache_dir)
     U2 = S2[:M, :M] - 1j * S2[:M, M:]
     U1 = S1[:M, :M] - 1j * S1[:M, M:]
 
@@ -0,0 +1,49 @@
+import numpy as np
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+# Array module of the MPI programs (distributed_*.py): cupy on GPU ranks, numpy on CPU-only clusters
+# or for testing the MPI logic with mpiexec on a laptop. Only the cupy backend needs cupy and a GPU.
+
+backends = ['numpy', 'cupy']
+
+def get_array_module(backend, device=None):
+    if backend == 'numpy':
+        return np
+    if backend != 'cupy':
+        raise ValueError(f'Unknown backend {backend}, use one of {backends}.')
+    if cp is None:
+        raise ImportError('The cupy backend needs cupy. Use --backend numpy on machines without GPUs.')
+    if device is not None:
+        cp.cuda.Device(device).use()
+    return cp
+
+def asnumpy(array):
+    if cp is not None:
+        return cp.asnumpy(array)
+    return np.asarray(array)
+
+def synchronize(xp):
+    if xp is not np:
+        xp.cuda.runtime.deviceSynchronize()
+
+def free_memory(xp):
+    if xp is not np:
+        xp.get_default_memory_pool().free_all_blocks()
+
+# Host buffer that is reused for MPI messages. Page-locked with cupy, so copies to and from the GPU go at full
+# bandwidth without a staging copy.
+def pinned_empty(xp, shape, dtype):
+    if xp is np:
+        return np.empty(shape, dtype=dtype)
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return np.frombuffer(xp.cuda.alloc_pinned_memory(size), dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+# Copies a device (or host) array into the host buffer out, of the same shape
+def copy_to_host(array, out):
+    if cp is not None and isinstance(array, cp.ndarray):
+        array.get(out=out)
+    else:
+        out[...] = array
@@ -0,0 +1,35 @@
+import numpy as np
+import argparse
+from mpi4py import MPI
+import distributed_kron
+import distributed_MPS
+import distributed_sampling
+from array_backend import free_memory
+from rank_store import RankStore
+
+# Runs distributed_kron.py, distributed_MPS.py and distributed_sampling.py in one job, with one launch, import
+# and CUDA context per rank. The cuts and the Gamma and Lambda tensors stay in the memory of the ranks instead of
+# going through local scratch, so no node-local disk is needed. Takes the arguments of the three programs except --ls.
+parser = argparse.ArgumentParser()
+parser.add_argument('--dir', type=str, help="Root directory.")
+parser.add_argument('--spill', type=str, help="Directory to also save the cuts and tensors to as a checkpoint, readable by the separate programs with --ls. Nothing is saved by default.", default=None)
+args = vars(parser.parse_known_args()[0])
+
+rootdir = args['dir']
+spill = args['spill']
+
+
+if __name__ == "__main__":
+
+    sq_cov = np.load(rootdir + "sq_cov.npy")
+    cov = np.load(rootdir + "cov.npy")
+    M = len(cov) // 2
+
+    store = RankStore(spill, MPI.COMM_WORLD.Get_rank(), keep=True)
+    distributed_kron.compute_cuts(sq_cov, M, store)
+    distributed_MPS.compute_MPS(sq_cov, M, store)
+    # The cuts are only needed for the MPS
+    for prefix in ['res_', 'num_', 'S_']:
+        store.free(prefix)
+    free_memory(distributed_MPS.xp)
+    distributed_sampling.sample_MPS(sq_cov, cov, store)
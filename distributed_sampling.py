@@ -1,9 +1,10 @@
 import numpy as np
-import cupy as cp
 from tqdm import tqdm
 import argparse
-import torch
-from scipy.linalg import expm
+from sampling_utils import batch_displaces, batch_alphas, philox_rng, written_rows, save_written_rows
+from array_backend import get_array_module, asnumpy, free_memory, pinned_empty, copy_to_host
+from site_partition import site_costs, partition_sites, rank_sites, site_owner
+from rank_store import RankStore
 import warnings
 import sys
 import os
@@ -16,15 +17,15 @@ def mpiabort_excepthook(type, value, traceback):
     print('value: ', value)
     print('traceback: ', traceback)
     print('An exception occured. Aborting MPI')
-    comm.Abort()
+    world.Abort()
 
 sys.excepthook = mpiabort_excepthook
 
 from decimal import *
 
 from mpi4py import MPI
-comm = MPI.COMM_WORLD
-rank = comm.Get_rank()
+world = MPI.COMM_WORLD
+world_rank = world.Get_rank()
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--N', type=int, help='Total number of samples.')
@@ -35,8 +36,13 @@ parser.add_argument('--dd', type=int, help='d for after random displacement. Max
 parser.add_argument('--chi', type=int, help='Bond dimension.')
 parser.add_argument('--dir', type=str, help="Root directory.")
 parser.add_argument('--ls', type=str, help="Local scratch directory.")
-parser.add_argument('--gpn', type=int, help="Number of GPUs per node")
-args = vars(parser.parse_args())
+parser.add_argument('--gpn', type=int, help="Number of GPUs per node", default=1)
+parser.add_argument('--replicas', type=int, help="Number of independent sampling pipelines. The ranks are split into this many groups, each sampling its share of the N samples.", default=1)
+parser.add_argument('--seed', type=int, help="Seed for reproducible sampling. The samples only depend on the seed (and N, n), not on the number of ranks or replicas.", default=None)
+parser.add_argument('--checkpoint', type=int, help="Number of batches between updates of the progress of samples_{i}.npy.", default=10)
+parser.add_argument('--depth', type=int, help="Number of batches whose vectors from the previous rank are received ahead, and of sends to the next rank in flight.", default=4)
+parser.add_argument('--backend', type=str, help="Array backend: cupy (one GPU per rank) or numpy (CPU-only ranks).", default='cupy')
+args = vars(parser.parse_known_args()[0]) # distributed_pipeline.py passes the arguments of all stages
 
 N = args['N']
 n = args['n']
@@ -48,188 +54,299 @@ rootdir = args['dir']
 path = rootdir + f'd_{d}_chi_{chi}/'
 local_scratch = args['ls']
 gpn = args['gpn']
+backend = args['backend']
+replicas = args['replicas']
+seed = args['seed']
+checkpoint = args['checkpoint']
+depth = args['depth']
 
-if not os.path.isdir(path) and rank==0:
+if not os.path.isdir(path) and world_rank==0:
     os.mkdir(path)
 
-cp.cuda.Device(rank % gpn).use()
+xp = get_array_module(backend, world_rank % gpn)
+
+# Replica r consists of a contiguous range of ranks of COMM_WORLD, starting at replica_first_ranks[r].
+# comm and rank refer to the pipeline of this rank's replica. In step s, replica r samples batch r + s * replicas,
+# so after every step the samples form a complete prefix of the output file.
+replica_colors = np.arange(world.Get_size()) * replicas // world.Get_size()
+replica = replica_colors[world_rank]
+replica_first_ranks = np.searchsorted(replica_colors, np.arange(replicas))
+replica_sizes = np.bincount(replica_colors, minlength=replicas)
+comm = world.Split(int(replica), world_rank)
+rank = comm.Get_rank()
+n_batches = (N + n - 1) // n
+n_steps = (n_batches + replicas - 1) // replicas
+if seed is None:
+    seed = world.bcast(np.random.SeedSequence().entropy if world_rank == 0 else None, root=0)
+    if world_rank == 0:
+        print(f'Seed: {seed}') # Rerun with --seed to reproduce
 
 def nothing_function(object):
     return object
 
+if world_rank != 0:
+    tqdm = nothing_function
 
-# Sampling operations on the first optical mode
-def sampling_beginning(displacements, Gamma, Lambda, i):
-    # For explanatory comments, see sampling_middle
-    res = []
-    req = None
-    Gamma = cp.sum(Gamma, axis=0) # chi x dd
-    for begin_batch in tqdm(range(0, N, n)):
 
-        end_batch = min(N, begin_batch + n)
-        samples_in_parallel = end_batch - begin_batch
-        iteration_displacements = displacements[begin_batch : end_batch]
-    
-        random_thresholds = cp.array(np.random.rand(samples_in_parallel, 1)) # samples_in_parallel
-        probs = []
-        temp_tensor = cp.einsum('mj,Bkj->Bmk', Gamma, iteration_displacements)
-        pre_tensor = cp.copy(temp_tensor)
-        temp_tensor = cp.abs(temp_tensor) ** 2
-        probs = [cp.dot(temp_tensor[:, :, j], Lambda ** 2) for j in range(dd)]
-        probs = cp.array(probs).T
-        probs = probs / cp.sum(probs, axis=1)[:, np.newaxis]
-        cumulative_probs = cp.cumsum(probs, axis=1)
-        random_thresholds = cp.repeat(random_thresholds, dd, axis=1) # samples_in_parallel x dd
-        has_more_photons = random_thresholds > cumulative_probs # samples_in_parallel x dd
-        n_photons = cp.sum(has_more_photons, axis=1)
-        res.append(cp.asnumpy(n_photons))
-        batch_to_n_ph = cp.zeros([samples_in_parallel, dd], dtype='complex64')
-        for n_ph in range(dd):
-            batch_to_n_ph[cp.where(n_photons == n_ph)[0], n_ph] = 1
-        pre_tensor = cp.einsum('BmP, BP -> Bm', pre_tensor, batch_to_n_ph)
-
-        if req != None:
-            req.wait()
-        req = comm.Isend([pre_tensor, MPI.C_FLOAT_COMPLEX], rank+1, tag=0)
-
-        np.save(path + f'samples_site_{rank}_{i}.npy', np.array(res).T)
-
-    if req != None:
-        req.wait()
-
-def sampling_middle(M, displacements, Gamma, Lambda, Lambda_pre, i):
-
-    res = []
-    req = None
-    Gamma = Gamma.reshape(chi, chi * dd)
-    # Samples at most n samples in parallel, until N samples are generated
-    for begin_batch in tqdm(range(0, N, n)):
+# Sampling operations on one optical mode for a batch. Returns the sampled photon numbers and the vector
+# propagated to the next mode. pre_tensor is None on the first mode, Lambda is None on the last mode.
+def sample_site(M, site, pre_tensor, Gamma, Lambda_pre, Lambda, displacements, random_thresholds):
+    samples_in_parallel = displacements.shape[0]
+    if site == 0:
+        temp_tensor = xp.einsum('mj,Bkj->Bmk', xp.sum(Gamma, axis=0), displacements) # chi x dd for the first mode
+    else:
+        temp_tensor = pre_tensor * Lambda_pre # samples_in_parallel x chi
+        temp_tensor = (temp_tensor @ Gamma.reshape(chi, chi * dd)).reshape(samples_in_parallel, chi, dd)
+        temp_tensor = xp.einsum('Bmj,Bkj->Bmk', temp_tensor, displacements) # Batch-parallel matrix multiplication
+    pre_tensor = xp.copy(temp_tensor)
+    temp_tensor = xp.abs(temp_tensor) ** 2
+
+    if site == M - 1:
+        probs = temp_tensor[:, 0, :]
+    else:
+        probs = xp.einsum('Bmj,m->Bj', temp_tensor, Lambda ** 2) # samples_in_parallel x dd
+
+    # This block is for batch parallel weighted random choice
+    random_thresholds = random_thresholds.reshape(samples_in_parallel, 1) # samples_in_parallel, on the device
+    probs = probs / xp.sum(probs, axis=1)[:, np.newaxis] # samples_in_parallel x dd
+    cumulative_probs = xp.cumsum(probs, axis=1) # samples_in_parallel x dd
+    random_thresholds = xp.repeat(random_thresholds, dd, axis=1) # samples_in_parallel x dd
+    has_more_photons = random_thresholds > cumulative_probs # samples_in_parallel x dd
+    n_photons = xp.sum(has_more_photons, axis=1) # samples_in_parallel
+    n_photons = xp.minimum(n_photons, dd - 1) # Rounding can leave the threshold above the last cumulative probability
+
+    # Selecting entries of pre_tensor depending on the sampled outcome.
+    pre_tensor = pre_tensor[xp.arange(samples_in_parallel), :, n_photons]
+    if site != 0:
+        # division by max is needed because otherwise the propagated vector will have decreasing magnitude as it go through the chain of modes.
+        # Each sample is scaled by its own maximum on the device, since the next mode normalizes the probabilities per sample, so there is no host sync.
+        # A zero row (an outcome with zero amplitude) stays zero instead of becoming NaN.
+        pre_tensor = pre_tensor / xp.maximum(xp.max(xp.abs(pre_tensor), axis=1, keepdims=True), xp.finfo(xp.float32).tiny)
+    return n_photons, pre_tensor
+
+# Gamma and Lambda tensors of the modes are in the store (local scratch or memory) of the rank that computed them
+# in distributed_MPS.py, with the partition of COMM_WORLD. Every rank sends its tensors to the ranks that sample
+# these modes in each replica, and receives the tensors of its own modes. Lambda is None for the last mode.
+def distribute_tensors(M, sites, store):
+    world_bounds = partition_sites(site_costs(M, chi), world.Get_size())
+    replica_bounds = [partition_sites(site_costs(M, chi), size) for size in replica_sizes]
+    requests = []
+    buffers = []
+    for site in rank_sites(world_bounds, world_rank):
+        Gamma = store.load(f'Gamma_{site}').astype('complex64')
+        Lambda = store.load(f'Lambda_{site}').astype('float32') if site != M - 1 else None
+        buffers.append((Gamma, Lambda))
+        for first_rank, bounds in zip(replica_first_ranks, replica_bounds):
+            target_rank = int(first_rank + site_owner(bounds, site))
+            requests.append(world.Isend([Gamma, MPI.C_FLOAT_COMPLEX], target_rank, tag=2 * site))
+            if Lambda is not None:
+                requests.append(world.Isend([Lambda, MPI.FLOAT], target_rank, tag=2 * site + 1))
+    Gammas = []
+    Lambdas = []
+    for site in sites:
+        source_rank = site_owner(world_bounds, site)
+        Gamma = np.zeros([chi, chi, d], dtype='complex64')
+        world.Recv([Gamma, MPI.C_FLOAT_COMPLEX], source=source_rank, tag=2 * site)
+        Gammas.append(Gamma)
+        Lambda = None
+        if site != M - 1:
+            Lambda = np.zeros(chi, dtype='float32')
+            world.Recv([Lambda, MPI.FLOAT], source=source_rank, tag=2 * site + 1)
+        Lambdas.append(Lambda)
+    MPI.Request.Waitall(requests)
+    return Gammas, Lambdas
+
+# Sample-major (N, M) int8 file samples_{i}.npy, written with MPI-IO by all ranks. The file view of each rank is the
+# columns of its modes, and the rows of each batch are written with a nonblocking independent Iwrite_at, so no rank
+# waits for the others. Every checkpoint steps, all ranks start a nonblocking reduction (minimum) of the number of
+# steps whose writes have completed. Rank 0 records the finished reductions in samples_{i}_progress.npy like
+# SampleWriter, lagging behind instead of stopping the pipeline. The file can be read while sampling
+# (load_written_samples), and an interrupted iteration resumes after the recorded rows.
+class ParallelSampleWriter:
+
+    def __init__(self, file, M, sites, first_step):
+        self.file = file
+        self.sites = sites
+        offset = None
+        if world_rank == 0:
+            if written_rows(file) == 0 or not os.path.isfile(file):
+                samples = np.lib.format.open_memmap(file, mode='w+', dtype='int8', shape=(N, M))
+                del samples
+                save_written_rows(file, 0)
+            offset = np.load(file, mmap_mode='r').offset
+        offset = world.bcast(offset, root=0)
+        self.fh = MPI.File.Open(world, file, MPI.MODE_WRONLY)
+        filetype = MPI.INT8_T
+        if len(sites) > 0:
+            filetype = MPI.INT8_T.Create_subarray([N, M], [N, len(sites)], [0, sites[0]]).Commit()
+        self.fh.Set_view(offset, MPI.INT8_T, filetype)
+        if len(sites) > 0:
+            filetype.Free()
+        self.pending = [] # (step, request, samples) of the writes in flight, in step order
+        self.reductions = [] # (request, steps, result) of the progress reductions in flight
+        self.steps_done = first_step
+
+    # Rows [begin_row, begin_row + len(samples)) of the columns of this rank's modes, or None if the rank has
+    # nothing to write in this step. The samples are kept until the write has completed.
+    def write(self, step, begin_row, samples):
+        request = MPI.REQUEST_NULL
+        if samples is not None:
+            request = self.fh.Iwrite_at(begin_row * len(self.sites), [samples, MPI.INT8_T])
+        self.pending.append((step, request, samples))
+
+    # Steps before this one have all been written by this rank
+    def completed_steps(self):
+        while len(self.pending) > 0 and self.pending[0][1].Test():
+            self.steps_done = self.pending.pop(0)[0] + 1
+        return self.steps_done
+
+    # Called by all ranks at the same steps, since the reductions are collective
+    def checkpoint(self):
+        steps = np.array([self.completed_steps()], dtype='int64')
+        result = np.zeros(1, dtype='int64')
+        self.reductions.append((world.Iallreduce([steps, MPI.INT64_T], [result, MPI.INT64_T], op=MPI.MIN), steps, result))
+        while len(self.reductions) > 0 and self.reductions[0][0].Test():
+            self.save_progress(self.reductions.pop(0)[2][0])
+
+    def save_progress(self, steps_done):
+        if world_rank == 0:
+            save_written_rows(self.file, min(N, steps_done * replicas * n))
+
+    def close(self):
+        MPI.Request.Waitall([request for _, request, _ in self.pending])
+        MPI.Request.Waitall([request for request, _, _ in self.reductions])
+        self.fh.Sync()
+        world.Barrier()
+        self.save_progress(n_steps)
+        self.fh.Close()
+
+# Sampling operations on the block of optical modes of this rank. The vector is passed from mode to mode
+# within the block, and only received from the previous rank and sent to the next rank at the block ends.
+# The alphas and thresholds of a batch are generated on every rank from the counter-based streams of the batch.
+# The vectors of the next depth batches are received into a ring of reused host buffers while the current batch is
+# computed, and up to depth sends to the next rank are in flight, so the pipeline stages wait on compute, not latency.
+def sampling_block(M, sites, sqrtW, Gammas, Lambdas, Lambda_pre, i, writer, first_step):
+
+    batches = [replica + step * replicas for step in range(first_step, n_steps)]
+    batches = [batch for batch in batches if batch < n_batches] if len(sites) > 0 else []
+    receiving = len(batches) > 0 and sites[0] != 0
+    sending = len(batches) > 0 and sites[-1] != M - 1
+    recv_buffers = [pinned_empty(xp, [n, chi], 'complex64') for _ in range(depth)] if receiving else []
+    send_buffers = [pinned_empty(xp, [n, chi], 'complex64') for _ in range(depth)] if sending else []
+    recv_requests = [MPI.REQUEST_NULL] * depth
+    send_requests = [MPI.REQUEST_NULL] * depth
+
+    # Preposts the receive of the j-th batch of this rank into its slot of the ring
+    def post_recv(j):
+        if receiving and j < len(batches):
+            rows = min(N, batches[j] * n + n) - batches[j] * n
+            recv_requests[j % depth] = comm.Irecv([recv_buffers[j % depth][:rows], MPI.C_FLOAT_COMPLEX], source=rank-1, tag=0)
+
+    for j in range(depth):
+        post_recv(j)
+    j = 0
+    # Samples at most n samples in parallel, until the N samples of this replica are generated
+    for step in tqdm(range(first_step, n_steps)):
+
+        batch = replica + step * replicas
+        if len(sites) == 0 or batch >= n_batches:
+            writer.write(step, None, None)
+            if (step + 1 - first_step) % checkpoint == 0:
+                writer.checkpoint() # Takes part in the progress reductions without samples
+            continue
 
+        begin_batch = batch * n
         end_batch = min(N, begin_batch + n)
         samples_in_parallel = end_batch - begin_batch
-        iteration_displacements = displacements[begin_batch : end_batch]
+        pure_alpha = batch_alphas(sqrtW, sites, seed, i, batch, samples_in_parallel).astype('complex64')
 
-        pre_tensor = np.zeros([samples_in_parallel, chi], dtype='complex64')
-        comm.Recv([pre_tensor, MPI.C_FLOAT_COMPLEX], source=rank-1, tag=0) # Receiving from previous node the vector
-        pre_tensor = cp.array(pre_tensor, dtype='complex64')
-        probs = []
-        temp_tensor = pre_tensor * Lambda_pre # samples_in_parallel x chi
-        temp_tensor = (temp_tensor @ Gamma).reshape(samples_in_parallel, chi, dd)
-        temp_tensor = cp.einsum('Bmj,Bkj->Bmk', temp_tensor, iteration_displacements) # Batch-parallel matrix multiplication
-        pre_tensor = cp.copy(temp_tensor)
-        temp_tensor = cp.abs(temp_tensor) ** 2
-
-        for j in range(dd):
-            if rank == M - 1:
-                probs.append(temp_tensor[:, 0, j])
-            else:
-                probs.append(cp.dot(temp_tensor[:, :, j], Lambda ** 2)); # appending shape samples_in_parallel
-        
-        # This block is for batch parallel weighted random choice
-        random_thresholds = cp.array(np.random.rand(samples_in_parallel, 1)) # samples_in_parallel
-        probs = cp.array(probs).T # samples_in_parallel x dd
-        probs = probs / cp.sum(probs, axis=1)[:, np.newaxis] # samples_in_parallel x dd
-        cumulative_probs = cp.cumsum(probs, axis=1) # samples_in_parallel x dd
-        random_thresholds = cp.repeat(random_thresholds, dd, axis=1) # samples_in_parallel x dd
-        has_more_photons = random_thresholds > cumulative_probs # samples_in_parallel x dd
-        n_photons = cp.sum(has_more_photons, axis=1) # samples_in_parallel
-        res.append(cp.asnumpy(n_photons)) # Appending sampling results
-
-        np.save(path + f'samples_site_{rank}_{i}.npy', np.array(res).astype('int8').T)
-
-        if rank == M - 1:
-            continue
-        
-        # Selecting entries of pre_tensor depending on the sampled outcome.
-        batch_to_n_ph = cp.zeros([samples_in_parallel, dd], dtype='complex64')
-        for n_ph in range(dd):
-            batch_to_n_ph[cp.where(n_photons == n_ph)[0], n_ph] = 1
-        pre_tensor = cp.asnumpy(cp.einsum('BmP, BP -> Bm', pre_tensor, batch_to_n_ph)) / pre_tensor.max().item() # division by max is needed because otherwise the propagated vector will have decreasing magnitude as it go through the chain of modes
-
-        if req != None:
-            req.wait()
-        # Sending pre_tensor vector to the next mode
-        req = comm.Isend([pre_tensor, MPI.C_FLOAT_COMPLEX], rank+1, tag=0)
-    
-    if req != None:
-        req.wait()
-
-
-def destroy(inputs):
-    data = np.sqrt(np.arange(1, inputs, dtype='complex64'))
-    return np.diag(data, 1);
-
-def batch_displaces(dim, alpha): # N is the dim
-    samples_in_parallel = alpha.shape[0]
-    a = destroy(dim)
-    a_h = np.conj(a).T
-    a = np.repeat(a[np.newaxis], samples_in_parallel, axis=0)
-    a_h = np.repeat(a_h[np.newaxis], samples_in_parallel, axis=0)
-    alpha = alpha.reshape(-1, 1, 1)
-    results = torch.linalg.matrix_exp(torch.tensor(alpha * a_h - np.conj(alpha) * a).cuda()).cpu().numpy()
-    return results
-
-def batch_mu_to_alpha(mu, hbar=2):
-    M = mu.shape[1] // 2
-    alpha = (mu[:, :M] + 1j * mu[:, M:]) / np.sqrt(2 * hbar)
-    return alpha
+        slot = j % depth
+        pre_tensor = None
+        if receiving:
+            recv_requests[slot].Wait() # Vector from the previous rank, received while the earlier batches were computed
+            pre_tensor = xp.array(recv_buffers[slot][:samples_in_parallel], dtype='complex64')
 
+        # The thresholds of all modes are copied to the device at once, and the photon numbers stay on the
+        # device until the whole batch is done, so there is one copy each way per batch instead of per mode
+        random_thresholds = xp.array(np.stack([philox_rng(seed, i, batch, 1 + site).random(samples_in_parallel) for site in sites]))
+        res = xp.empty([samples_in_parallel, len(sites)], dtype='int8')
+        for k, site in enumerate(sites):
+            iteration_displacements = xp.array(batch_displaces(dd, pure_alpha[:, k])) # Only generated for the current batch
+            n_photons, pre_tensor = sample_site(M, site, pre_tensor, Gammas[k], Lambda_pre if k == 0 else Lambdas[k - 1], Lambdas[k], iteration_displacements, random_thresholds[k])
+            res[:, k] = n_photons # Sampling results
+        samples = asnumpy(res)
+        post_recv(j + depth) # The slot was copied to the device before the batch was computed
 
+        if sending:
+            send_requests[slot].Wait() # Only waits for the send depth batches ago that used this buffer
+            copy_to_host(pre_tensor, send_buffers[slot][:samples_in_parallel])
+            send_requests[slot] = comm.Isend([send_buffers[slot][:samples_in_parallel], MPI.C_FLOAT_COMPLEX], rank+1, tag=0)
+        j += 1
+
+        writer.write(step, begin_batch, samples)
+        if (step + 1 - first_step) % checkpoint == 0:
+            writer.checkpoint()
+
+    MPI.Request.Waitall(send_requests)
+
+
+
+
+# Samples iterations x N samples from the MPS whose Gamma and Lambda tensors are in store
+def sample_MPS(sq_cov, cov, store):
 
-if __name__ == "__main__":
-    
-    sq_cov = np.load(rootdir + "sq_cov.npy")
-    cov = np.load(rootdir + "cov.npy")
     thermal_cov = cov - sq_cov;
     thermal_cov = thermal_cov + 1.000001 * np.eye(len(thermal_cov)) * np.abs(np.min(np.linalg.eigvalsh(thermal_cov)))
     sqrtW = np.linalg.cholesky(thermal_cov)
 
     M = sqrtW.shape[0] // 2
-    assert M == comm.Get_size()
-    Lambda = None
-    # Last mode (rank) does not need to have load Lambda from the right
-    if rank != M - 1:
-        Lambda = np.load(local_scratch + f'/Lambda_{rank}.npy') # Loading right Lambda
-        req = comm.Isend([Lambda, MPI.FLOAT], rank + 1, tag=0) # Sending loaded Lambda to the next mode as its left Lambda
-        Lambda = cp.array(Lambda, dtype='float32')
-        Lambda = Lambda / cp.sum(cp.abs(Lambda)**2)
-    # First mode (rank) does not need to receive Lambda from left
-    if rank != 0:
+    # Each rank samples a contiguous block of modes in its replica. Ranks without modes (more ranks than modes)
+    # only take part in the collective writes.
+    bounds = partition_sites(site_costs(M, chi), comm.Get_size())
+    sites = rank_sites(bounds, rank)
+    Gammas_small, Lambdas_loaded = distribute_tensors(M, sites, store)
+    Lambdas = []
+    for site, Lambda in zip(sites, Lambdas_loaded):
+        # Last mode does not have a Lambda on the right
+        if Lambda is None:
+            Lambdas.append(None)
+            continue
+        if site == sites[-1]:
+            req = comm.Isend([Lambda, MPI.FLOAT], rank + 1, tag=0) # Sending right Lambda to the next rank as its left Lambda
+        Lambda = xp.array(Lambda, dtype='float32')
+        Lambdas.append(Lambda / xp.sum(xp.abs(Lambda)**2))
+    # First mode does not need to receive Lambda from left
+    Lambda_pre = None
+    if len(sites) > 0 and sites[0] != 0:
         Lambda_pre = np.zeros(chi, dtype='float32')
         comm.Recv([Lambda_pre, MPI.FLOAT], source=rank - 1, tag=0) # Receiving left Lambda
-        Lambda_pre = cp.array(Lambda_pre, dtype='float32')
-        Lambda_pre = Lambda_pre / cp.sum(cp.abs(Lambda_pre)**2)
-        tqdm = nothing_function
-    if rank != M - 1:
+        Lambda_pre = xp.array(Lambda_pre, dtype='float32')
+        Lambda_pre = Lambda_pre / xp.sum(xp.abs(Lambda_pre)**2)
+    if len(sites) > 0 and sites[-1] != M - 1:
         req.wait() # Synchronize upon completion of send
 
-    Gamma_small = np.load(local_scratch + f'Gamma_{rank}.npy') # Load constructed MPS Gamma tensor with local Hilbert space dimension d (small)
-    Gamma = np.zeros([chi, chi, dd], dtype='complex64') # Initialize MPS Gamma tensor that will store displaced Gamma. Larger local Hilbert space dimension dd
-    Gamma[:, :, :d] = Gamma_small
-    Gamma = cp.array(Gamma, dtype='complex64')
+    Gammas = []
+    for Gamma_small in Gammas_small: # Constructed MPS Gamma tensors with local Hilbert space dimension d (small)
+        Gamma = np.zeros([chi, chi, dd], dtype='complex64') # Initialize MPS Gamma tensor that will store displaced Gamma. Larger local Hilbert space dimension dd
+        Gamma[:, :, :d] = Gamma_small
+        Gammas.append(xp.array(Gamma, dtype='complex64'))
 
     # Repeat sampling for 'iterations' times
     for i in range(iterations):
 
-        # rank 0 generates alphas needed for random displacement matrices
-        if rank == 0:
-            print('Generating random displacements')
-            random_array = np.random.normal(size=(2 * M, N))
-            pure_mu = sqrtW @ random_array
-            pure_mu = pure_mu.T
-            pure_alphas = batch_mu_to_alpha(pure_mu, hbar=2).astype('complex64')
-            for target_rank in range(1, M):
-                comm.Send([np.ascontiguousarray(pure_alphas[:, target_rank]), MPI.C_FLOAT_COMPLEX], target_rank, tag=0)
-            pure_alpha = pure_alphas[:, 0]
-        # other ranks receive the generated alphas
-        else:
-            pure_alpha = np.zeros(N, dtype='complex64')
-            comm.Recv([pure_alpha, MPI.C_FLOAT_COMPLEX], source=0, tag=0)
-        # generate displacement matrices from alphas
-        displacements = batch_displaces(dd, pure_alpha)
-        cp.get_default_memory_pool().free_all_blocks()
-
-        if rank == 0:
-            sampling_beginning(displacements, Gamma, Lambda, i)
-        else:
-            sampling_middle(M, displacements, Gamma, Lambda, Lambda_pre, i)
\ No newline at end of file
+        free_memory(xp)
+
+        # Resumes after the last recorded progress if this iteration was interrupted
+        file = rootdir + f'samples_{i}.npy'
+        first_step = world.bcast(written_rows(file) // (replicas * n) if world_rank == 0 else None, root=0)
+        writer = ParallelSampleWriter(file, M, sites, first_step)
+        # alphas and displacement matrices are generated batch by batch on every rank
+        sampling_block(M, sites, sqrtW, Gammas, Lambdas, Lambda_pre, i, writer, first_step)
+        writer.close()
+
+
+if __name__ == "__main__":
+
+    sq_cov = np.load(rootdir + "sq_cov.npy")
+    cov = np.load(rootdir + "cov.npy")
+    sample_MPS(sq_cov, cov, RankStore(local_scratch, world_rank))
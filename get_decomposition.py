@@ -1,30 +1,101 @@
 import numpy as np
-import cvxpy as cp
 import argparse
+import time
 import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dir', type=str, help="Experiment directory.")
+parser.add_argument('--solver', type=str, help="admm (numpy, default) or cvxpy (generic SDP with CVXOPT, for reference).", default='admm')
+parser.add_argument('--tol', type=float, help="Relative primal and dual residual tolerance of the admm solver.", default=1e-8)
+parser.add_argument('--max_iter', type=int, help="Maximum number of admm iterations.", default=100000)
+parser.add_argument('--warm', type=str, help="sq_cov.npy of a similar experiment (e.g. another squeezing level) to warm start admm from. Uses sq_cov_dual.npy next to it if available.", default=None)
+parser.add_argument('--compare', type=str, help="Reference sq_cov.npy to report the maximum deviation from.", default=None)
 args = vars(parser.parse_args())
 
 dir = args['dir']
 
-if os.path.isfile(dir + 'sq_cov.npy'):
-    print('Decomposition results already available.')
-    quit()
-
-cov = np.load(dir + "cov.npy")
-omega = np.array([[0, 1], [-1, 0]])
-M = len(cov) // 2;
-Omega = np.kron(omega, np.eye(M))
-
-n = 2 * M
-X = cp.Variable((n,n), symmetric=True)
-constraints = [cp.bmat([[X, Omega], [-Omega, X]]) >> 0]
-constraints += [cov - X >> 0]
-prob = cp.Problem(cp.Minimize(cp.trace(X)),
-                    constraints)
-prob.solve(solver = 'CVXOPT')
-sq_cov = X.value
-
-np.save(dir + 'sq_cov.npy', sq_cov)
\ No newline at end of file
+def psd_projection(A):
+    vals, vecs = np.linalg.eigh(A)
+    return (vecs * np.maximum(vals, 0)) @ vecs.conj().T
+
+# Solves min tr(X) subject to X + i Omega >= 0 and X <= cov by ADMM on the Hermitian variable Z = X + i Omega.
+# Each iteration projects onto {X <= cov} (real eigh) and onto the PSD cone (complex eigh).
+# The returned X always satisfies X <= cov exactly, and X + i Omega >= 0 up to the primal residual.
+def admm_decomposition(cov, X0=None, dual0=None, tol=1e-8, max_iter=100000, rho=1.0):
+    n = len(cov)
+    M = n // 2
+    Omega = np.kron(np.array([[0, 1], [-1, 0]]), np.eye(M))
+    I = np.eye(n)
+    if X0 is None:
+        X0 = cov
+    W = psd_projection(X0 + 1j * Omega)
+    U = np.zeros_like(W)
+    if dual0 is not None:
+        U = dual0 / rho
+    for iteration in range(1, max_iter + 1):
+        Y = (W - U).real - I / rho
+        X = cov - psd_projection(cov - Y)
+        Z = X + 1j * Omega
+        W_pre = W
+        W = psd_projection(Z + U)
+        U = U + Z - W
+        primal_residual = np.linalg.norm(Z - W)
+        dual_residual = rho * np.linalg.norm(W - W_pre)
+        if primal_residual < tol * max(np.linalg.norm(Z), np.linalg.norm(W)) and dual_residual < tol * rho * np.linalg.norm(U):
+            break
+        # Residual balancing
+        if primal_residual > 10 * dual_residual:
+            rho *= 2
+            U /= 2
+        elif dual_residual > 10 * primal_residual:
+            rho /= 2
+            U *= 2
+    info = {'iterations': iteration, 'primal_residual': primal_residual, 'dual_residual': dual_residual,
+            'min_eig': np.linalg.eigvalsh(X + 1j * Omega).min(), 'dual': rho * U}
+    return X, info
+
+def cvxpy_decomposition(cov):
+    import cvxpy as cp
+    omega = np.array([[0, 1], [-1, 0]])
+    M = len(cov) // 2;
+    Omega = np.kron(omega, np.eye(M))
+
+    n = 2 * M
+    X = cp.Variable((n,n), symmetric=True)
+    constraints = [cp.bmat([[X, Omega], [-Omega, X]]) >> 0]
+    constraints += [cov - X >> 0]
+    prob = cp.Problem(cp.Minimize(cp.trace(X)),
+                        constraints)
+    prob.solve(solver = 'CVXOPT')
+    return X.value
+
+
+if __name__ == "__main__":
+
+    if os.path.isfile(dir + 'sq_cov.npy'):
+        print('Decomposition results already available.')
+        quit()
+
+    cov = np.load(dir + "cov.npy")
+
+    start = time.time()
+    if args['solver'] == 'cvxpy':
+        sq_cov = cvxpy_decomposition(cov)
+    else:
+        X0 = None
+        dual0 = None
+        if args['warm'] is not None:
+            X0 = np.load(args['warm'])
+            # The dual variable is saved next to sq_cov.npy by previous admm runs
+            dual_file = args['warm'].replace('sq_cov.npy', 'sq_cov_dual.npy')
+            if os.path.isfile(dual_file):
+                dual0 = np.load(dual_file)
+        sq_cov, info = admm_decomposition(cov, X0, dual0, args['tol'], args['max_iter'])
+        np.save(dir + 'sq_cov_dual.npy', info['dual'])
+        print('ADMM: {} iterations, primal residual {:.3e}, dual residual {:.3e}, min eigenvalue of sq_cov + i Omega {:.3e}.'.format(
+            info['iterations'], info['primal_residual'], info['dual_residual'], info['min_eig']))
+    print('Decomposition time {}, trace {}.'.format(time.time() - start, np.trace(sq_cov)))
+    if args['compare'] is not None:
+        print('Maximum deviation from reference: {:.3e}.'.format(np.abs(sq_cov - np.load(args['compare'])).max()))
+
+    np.save(dir + 'sq_cov.npy', sq_cov)
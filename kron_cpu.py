@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.linalg import block_diag, sqrtm, schur
+from symplectic import cached_williamson, get_cache_dir
 import argparse
 import os
 
@@ -17,88 +17,20 @@ args = vars(parser.parse_args())
 d = args['d']
 chi = args['chi']
 rootdir = args['dir']
+cache_dir = get_cache_dir(rootdir)
 
 
 
-def sympmat(N, dtype=np.float64):
-    I = np.identity(N, dtype=dtype)
-    O = np.zeros_like(I, dtype=dtype)
-    S = np.block([[O, I], [-I, O]])
-    return S
-
-def xpxp_to_xxpp(S):
-    shape = S.shape
-    n = shape[0]
-
-    if n % 2 != 0:
-        raise ValueError("The input array is not even-dimensional")
-
-    n = n // 2
-    ind = np.arange(2 * n).reshape(-1, 2).T.flatten()
-
-    if len(shape) == 2:
-        if shape[0] != shape[1]:
-            raise ValueError("The input matrix is not square")
-        return S[:, ind][ind]
-
-    return S[ind]
-
-def williamson(V, tol=1e-11):
-    (n, m) = V.shape
-
-    if n != m:
-        raise ValueError("The input matrix is not square")
-
-    diffn = np.linalg.norm(V - np.transpose(V))
-
-    if diffn >= tol:
-        raise ValueError("The input matrix is not symmetric")
-
-    if n % 2 != 0:
-        raise ValueError("The input matrix must have an even number of rows/columns")
-
-    n = n // 2
-    omega = sympmat(n)
-    vals = np.linalg.eigvalsh(V)
-
-    for val in vals:
-        if val <= 0:
-            raise ValueError("Input matrix is not positive definite")
-
-    Mm12 = sqrtm(np.linalg.inv(V)).real
-    r1 = Mm12 @ omega @ Mm12
-    s1, K = schur(r1)
-    X = np.array([[0, 1], [1, 0]])
-    I = np.identity(2)
-    seq = []
-
-    for i in range(n):
-        if s1[2 * i, 2 * i + 1] > 0:
-            seq.append(I)
-        else:
-            seq.append(X)
-
-    p = block_diag(*seq)
-    Kt = K @ p
-    s1t = p @ s1 @ p
-    dd = xpxp_to_xxpp(s1t)
-    perm_indices = xpxp_to_xxpp(np.arange(2 * n))
-    Ktt = Kt[:, perm_indices]
-    Db = np.diag([1 / dd[i, i + n] for i in range(n)] + [1 / dd[i, i + n] for i in range(n)])
-    S = Mm12 @ Ktt @ sqrtm(Db)
-    return Db, np.linalg.inv(S).T
-
-
 def thermal_photons(nth, cutoff = 20):
     return 1 / (nth + 1) * (nth / (nth + 1)) ** np.arange(cutoff)
 
-def get_cumsum_kron(sq_cov, L, chi = 100, max_dim = 10 ** 5, cutoff = 6, err_tol = 10 ** (-12)):
+def get_cumsum_kron(sq_cov, L, chi = 100, max_dim = 10 ** 5, cutoff = 6, err_tol = 10 ** (-12), cache_dir = None):
     M = len(sq_cov) // 2
     mode = np.arange(L, M)
     modes = np.append(mode, mode + M)
     sq_cov_A = sq_cov[np.ix_(modes, modes)]
 
-    D, S = williamson(sq_cov_A)
+    D, S = cached_williamson(sq_cov_A, cache_dir)
     d = (np.diag(D) - 1) / 2
 
     d[d < 0] = 0
@@ -146,7 +78,7 @@ if __name__ == "__main__":
 
     for compute_site in range(M - 1):
         
-        res, num, S_l = get_cumsum_kron(sq_cov, compute_site + 1, max_dim = max_dim, chi = chi, cutoff = d)
+        res, num, S_l = get_cumsum_kron(sq_cov, compute_site + 1, max_dim = max_dim, chi = chi, cutoff = d, cache_dir = cache_dir)
         print(compute_site, np.sum(res))
         np.save(path + f'res_{compute_site}.npy', res)
         np.save(path + f'num_{compute_site}.npy', num)
@@ -0,0 +1,32 @@
+import numpy as np
+import os
+
+# Intermediate arrays of the MPI programs (cuts res/num/S, Gamma and Lambda tensors), by name, e.g. 'Gamma_3'.
+# The separate programs pass them through files in directory (local scratch). distributed_pipeline.py keeps them
+# in the memory of the rank (keep=True), and only writes them to directory if one is given, as a checkpoint.
+# Files are written under a temporary name and renamed, since on a shared directory two ranks can save the same
+# cut (the owner of a cut and the next rank, which receives it).
+class RankStore:
+
+    def __init__(self, directory=None, rank=0, keep=False):
+        self.directory = directory
+        self.rank = rank
+        self.keep = keep
+        self.arrays = {}
+
+    def save(self, name, array):
+        if self.keep:
+            self.arrays[name] = array
+        if self.directory is not None:
+            temp_file = self.directory + f'{name}_{self.rank}.tmp.npy'
+            np.save(temp_file, array)
+            os.replace(temp_file, self.directory + f'{name}.npy')
+
+    def load(self, name):
+        if name in self.arrays:
+            return self.arrays[name]
+        return np.load(self.directory + f'{name}.npy')
+
+    # Frees the arrays kept in memory whose names start with prefix, once the next stage does not need them
+    def free(self, prefix):
+        self.arrays = {key: value for key, value in self.arrays.items() if not key.startswith(prefix)}
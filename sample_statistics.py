@@ -0,0 +1,125 @@
+import numpy as np
+
+# Streaming statistics of samples, accumulated chunk by chunk while sampling, so that the correlation
+# benchmarks are available without reloading the samples. Accumulators of different workers, runs or
+# MPI ranks add up with merge (or reduce).
+
+# Mode tuples for sampled higher-order correlations, drawn like in the analysis notebooks
+# (np.random.seed(1), then np.random.choice for each tuple).
+def sampled_mode_tuples(M, L, order=3, seed=1):
+    random_state = np.random.RandomState(seed)
+    return np.array([np.sort(random_state.choice(np.arange(M), order, replace=False)) for _ in range(L)])
+
+# Sum of two histograms of possibly different lengths
+def add_histograms(histogram, counts):
+    if len(counts) > len(histogram):
+        histogram = np.concatenate([histogram, np.zeros(len(counts) - len(histogram), dtype=histogram.dtype)])
+    histogram[:len(counts)] += counts
+    return histogram
+
+# Joint cumulant of three variables from the moments of all their subsets
+def third_cumulant(m_i, m_j, m_k, m_ij, m_ik, m_jk, m_ijk):
+    return m_ijk - m_ij * m_k - m_ik * m_j - m_jk * m_i + 2 * m_i * m_j * m_k
+
+class SampleStatistics:
+
+    # clicks: the samples are click patterns (0/1), so only the click statistics are accumulated.
+    # tuples: optional (L, order) array of modes whose products are accumulated, e.g. from sampled_mode_tuples.
+    def __init__(self, M, clicks=False, tuples=None):
+        self.M = M
+        self.clicks = clicks
+        self.count = 0
+        self.click_sums = np.zeros(M)
+        self.click_products = np.zeros([M, M])
+        self.click_histogram = np.zeros(M + 1, dtype=np.int64)
+        self.tuples = np.zeros([0, 3], dtype=np.int64) if tuples is None else np.asarray(tuples, dtype=np.int64)
+        self.tuple_click_products = np.zeros(len(self.tuples))
+        if not clicks:
+            self.photon_sums = np.zeros(M)
+            self.photon_products = np.zeros([M, M])
+            self.photon_histogram = np.zeros(1, dtype=np.int64)
+            self.tuple_photon_products = np.zeros(len(self.tuples))
+
+    # chunk: (n, M) photon numbers, or (n, M) click patterns if clicks
+    def update(self, chunk):
+        chunk = np.asarray(chunk)
+        self.count += chunk.shape[0]
+        click = (chunk > 0).astype(np.float64)
+        self.click_sums += click.sum(axis=0)
+        self.click_products += click.T @ click
+        self.click_histogram += np.bincount(chunk.astype(bool).sum(axis=1), minlength=self.M + 1)
+        if len(self.tuples) > 0:
+            self.tuple_click_products += np.prod(click[:, self.tuples], axis=2).sum(axis=0)
+        if self.clicks:
+            return
+        photons = chunk.astype(np.float64)
+        self.photon_sums += photons.sum(axis=0)
+        self.photon_products += photons.T @ photons
+        self.photon_histogram = add_histograms(self.photon_histogram, np.bincount(chunk.astype(np.int64).sum(axis=1)))
+        if len(self.tuples) > 0:
+            self.tuple_photon_products += np.prod(photons[:, self.tuples], axis=2).sum(axis=0)
+
+    def merge(self, other):
+        assert self.M == other.M and self.clicks == other.clicks and np.array_equal(self.tuples, other.tuples)
+        self.count += other.count
+        self.click_sums += other.click_sums
+        self.click_products += other.click_products
+        self.click_histogram += other.click_histogram
+        self.tuple_click_products += other.tuple_click_products
+        if not self.clicks:
+            self.photon_sums += other.photon_sums
+            self.photon_products += other.photon_products
+            self.photon_histogram = add_histograms(self.photon_histogram, other.photon_histogram)
+            self.tuple_photon_products += other.tuple_photon_products
+        return self
+
+    # Merges the accumulators of all ranks of comm on root. Returns the merged statistics on root, None elsewhere.
+    def reduce(self, comm, root=0):
+        parts = comm.gather(self, root=root)
+        if comm.Get_rank() != root:
+            return None
+        merged = SampleStatistics(self.M, self.clicks, self.tuples)
+        for part in parts:
+            merged.merge(part)
+        return merged
+
+    def save(self, file):
+        fields = {'M': self.M, 'clicks': self.clicks, 'count': self.count, 'tuples': self.tuples,
+                  'click_sums': self.click_sums, 'click_products': self.click_products,
+                  'click_histogram': self.click_histogram, 'tuple_click_products': self.tuple_click_products}
+        if not self.clicks:
+            fields.update({'photon_sums': self.photon_sums, 'photon_products': self.photon_products,
+                           'photon_histogram': self.photon_histogram, 'tuple_photon_products': self.tuple_photon_products})
+        np.savez(file, **fields)
+
+    # Means, pairwise cumulants (in the order of itertools.combinations) and the cumulants of the tuples,
+    # of the photon numbers or, with clicks=True, of the click patterns as in the analysis notebooks.
+    def first_order(self, clicks=False):
+        sums = self.click_sums if clicks else self.photon_sums
+        return sums / self.count
+
+    def second_moments(self, clicks=False):
+        products = self.click_products if clicks else self.photon_products
+        return products / self.count
+
+    def second_order(self, clicks=False):
+        means = self.first_order(clicks)
+        covariance = self.second_moments(clicks) - np.outer(means, means)
+        return covariance[np.triu_indices(self.M, 1)]
+
+    def third_order(self, clicks=False):
+        assert self.tuples.shape[1] == 3
+        means = self.first_order(clicks)
+        moments = self.second_moments(clicks)
+        products = (self.tuple_click_products if clicks else self.tuple_photon_products) / self.count
+        i, j, k = self.tuples.T
+        return third_cumulant(means[i], means[j], means[k], moments[i, j], moments[i, k], moments[j, k], products)
+
+def load_statistics(file):
+    data = np.load(file)
+    statistics = SampleStatistics(int(data['M']), bool(data['clicks']), data['tuples'])
+    statistics.count = int(data['count'])
+    for name in data.files:
+        if name not in ('M', 'clicks', 'count', 'tuples'):
+            setattr(statistics, name, data[name])
+    return statistics
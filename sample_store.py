@@ -0,0 +1,184 @@
+import numpy as np
+import os
+from sampling_utils import SampleWriter, load_written_samples
+
+# Chunked, compressed sample store. A store is a directory with
+#   data.npy:    (rows, width) uint8 encoded samples, appended chunk by chunk through SampleWriter,
+#   sectors.npy: (entries, 2) int64 rows [N, count], the number of samples of each nonempty sector of total photon
+#                (or click) number N, chunk after chunk, so that samples of one sector are read from the matching
+#                chunks only,
+#   chunks.npy:  (chunks, 2) int64 rows [end row, end entry] of each chunk in data.npy and sectors.npy,
+#   index.npz:   M and the encoding, written once.
+# The chunk and sector files are appended through SampleWriter like the data, so appending a chunk costs I/O in
+# the size of the chunk only. A chunk belongs to the store once its row of chunks.npy is recorded.
+# Encodings: 'nibble' stores two photon numbers (0 to 15) per byte, 'bits' stores click patterns with
+# np.packbits, and 'int8' stores photon numbers unencoded. Reading decodes lazily from a memory map.
+
+encodings = ['nibble', 'bits', 'int8']
+
+def encoded_width(M, encoding):
+    if encoding == 'nibble':
+        return (M + 1) // 2
+    if encoding == 'bits':
+        return (M + 7) // 8
+    return M
+
+def encode(samples, encoding):
+    samples = np.asarray(samples)
+    if encoding == 'bits':
+        return np.packbits(samples > 0, axis=1)
+    if encoding == 'int8':
+        return samples.astype('uint8')
+    if samples.max(initial=0) > 15:
+        raise ValueError('Photon numbers above 15 do not fit the nibble encoding, use int8.')
+    if samples.shape[1] % 2 == 1:
+        samples = np.concatenate([samples, np.zeros([samples.shape[0], 1], dtype=samples.dtype)], axis=1)
+    samples = samples.astype('uint8')
+    return samples[:, 0::2] | (samples[:, 1::2] << 4)
+
+def decode(encoded, M, encoding):
+    encoded = np.asarray(encoded)
+    if encoding == 'bits':
+        return np.unpackbits(encoded, axis=1, count=M).astype('int8')
+    if encoding == 'int8':
+        return encoded.astype('int8')
+    samples = np.empty([encoded.shape[0], 2 * encoded.shape[1]], dtype='int8')
+    samples[:, 0::2] = encoded & 15
+    samples[:, 1::2] = encoded >> 4
+    return samples[:, :M]
+
+def default_encoding(clicks, dd):
+    if clicks:
+        return 'bits'
+    return 'nibble' if dd <= 16 else 'int8'
+
+class SampleStore:
+
+    # mode 'a' creates the store or continues an existing one, mode 'r' opens it read-only,
+    # which also works while another process is still appending.
+    def __init__(self, path, M=None, encoding=None, capacity=0, mode='a'):
+        self.path = path
+        self.mode = mode
+        if os.path.isfile(path + 'index.npz'):
+            with np.load(path + 'index.npz') as index:
+                self.M = int(index['M'])
+                self.encoding = str(index['encoding'])
+        else:
+            if mode == 'r':
+                raise FileNotFoundError(path + 'index.npz')
+            if encoding not in encodings:
+                raise ValueError(f'Unknown encoding {encoding}, use one of {encodings}.')
+            self.M = M
+            self.encoding = encoding
+        chunks = self.load_index('chunks.npy')
+        entries = int(chunks[-1, 1]) if len(chunks) > 0 else 0
+        self.load_sector_counts(chunks, self.load_index('sectors.npy')[:entries])
+        if mode == 'a':
+            os.makedirs(path, exist_ok=True)
+            if not os.path.isfile(path + 'index.npz'):
+                temp_file = path + 'index.tmp.npz'
+                np.savez(temp_file, M=self.M, encoding=self.encoding)
+                os.replace(temp_file, path + 'index.npz')
+            self.writer = SampleWriter(path + 'data.npy', encoded_width(self.M, self.encoding), max(capacity, 1), dtype='uint8')
+            self.sector_writer = SampleWriter(path + 'sectors.npy', 2, 1024, dtype=np.int64)
+            self.chunk_writer = SampleWriter(path + 'chunks.npy', 2, 1024, dtype=np.int64)
+            # Rows and entries written after the last chunk row belong to an interrupted chunk
+            self.writer.count = self.count
+            self.sector_writer.count = entries
+
+    def load_index(self, name):
+        if not os.path.isfile(self.path + name):
+            return np.zeros([0, 2], dtype=np.int64)
+        return np.array(load_written_samples(self.path + name))
+
+    # The index is kept in memory with spare capacity (doubled when full), so adding a chunk is amortized O(1)
+    def load_sector_counts(self, chunks, sectors):
+        self.n_chunks = len(chunks)
+        self.width = int(sectors[:, 0].max()) + 1 if len(sectors) > 0 else 1
+        self._offsets = np.zeros(2 * self.n_chunks + 2, dtype=np.int64)
+        self._offsets[1 : self.n_chunks + 1] = chunks[:, 0]
+        self._sector_counts = np.zeros([2 * self.n_chunks + 1, self.width], dtype=np.int64)
+        entry_counts = np.diff(chunks[:, 1], prepend=0)
+        np.add.at(self._sector_counts, (np.repeat(np.arange(self.n_chunks), entry_counts), sectors[:, 0]), sectors[:, 1])
+
+    def add_chunk(self, end, counts):
+        rows, width = self._sector_counts.shape
+        if self.n_chunks == rows or len(counts) > width:
+            if self.n_chunks == rows:
+                rows *= 2
+                self._offsets = np.append(self._offsets, np.zeros(rows + 1 - len(self._offsets), dtype=np.int64))
+            sector_counts = np.zeros([rows, max(width, 2 * len(counts)) if len(counts) > width else width], dtype=np.int64)
+            sector_counts[:self.n_chunks, :width] = self._sector_counts[:self.n_chunks]
+            self._sector_counts = sector_counts
+        self._sector_counts[self.n_chunks, :len(counts)] = counts
+        self._offsets[self.n_chunks + 1] = end
+        self.n_chunks += 1
+        self.width = max(self.width, len(counts))
+
+    # Row offsets of the chunks in data.npy (chunks + 1)
+    @property
+    def offsets(self):
+        return self._offsets[:self.n_chunks + 1]
+
+    # Number of samples of each total photon (or click) number, per chunk (chunks x sectors)
+    @property
+    def sector_counts(self):
+        return self._sector_counts[:self.n_chunks, :self.width]
+
+    @property
+    def count(self):
+        return int(self.offsets[-1])
+
+    def __len__(self):
+        return self.count
+
+    # samples: (n, M) photon numbers, or 0/1 click patterns for the 'bits' encoding
+    def append(self, samples):
+        samples = np.asarray(samples)
+        counts = np.bincount(samples.astype(np.int64).sum(axis=1))
+        sectors = np.flatnonzero(counts)
+        self.writer.append(encode(samples, self.encoding))
+        self.sector_writer.append(np.stack([sectors, counts[sectors]], axis=1))
+        self.chunk_writer.append(np.array([[self.writer.count, self.sector_writer.count]], dtype=np.int64))
+        self.add_chunk(self.writer.count, counts)
+
+    def data(self):
+        if self.mode == 'a':
+            return self.writer.samples
+        return np.load(self.path + 'data.npy', mmap_mode='r')
+
+    def read(self, begin, end):
+        return decode(self.data()[begin:end], self.M, self.encoding)
+
+    def chunk(self, c):
+        return self.read(self.offsets[c], self.offsets[c + 1])
+
+    # Number of samples with each total photon (or click) number
+    def sector_sizes(self):
+        return self.sector_counts.sum(axis=0)
+
+    # The first k samples (all if k is None) whose total photon (or click) number is N.
+    # Only the chunks whose index has samples in the sector are read and decoded.
+    def sector(self, N, k=None):
+        if N >= self.sector_counts.shape[1]:
+            return np.zeros([0, self.M], dtype='int8')
+        found = []
+        remaining = self.count if k is None else k
+        data = self.data()
+        for c in np.flatnonzero(self.sector_counts[:, N]):
+            if remaining <= 0:
+                break
+            samples = decode(data[self.offsets[c] : self.offsets[c + 1]], self.M, self.encoding)
+            samples = samples[samples.astype(np.int64).sum(axis=1) == N][:remaining]
+            found.append(samples)
+            remaining -= len(samples)
+        if len(found) == 0:
+            return np.zeros([0, self.M], dtype='int8')
+        return np.concatenate(found)
+
+# Converts dense (rows, M) samples, e.g. a samples_{i}.npy file or experimental samples, into a store
+def convert_samples(samples, path, encoding, chunk_rows=10 ** 5):
+    store = SampleStore(path, samples.shape[1], encoding, samples.shape[0])
+    for begin in range(store.count, samples.shape[0], chunk_rows):
+        store.append(samples[begin : begin + chunk_rows])
+    return store
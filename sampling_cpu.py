@@ -1,8 +1,10 @@
 import numpy as np
-from tqdm import tqdm
 import time
 import argparse
-from scipy.linalg import expm
+import os
+from sampling_utils import sample_chunks, parallel_sample_chunks, pipelined_sample_chunks, site_major_sampling, get_sqrtW, load_Lambda, load_Gammas, SampleWriter, unpack_clicks, sector_quota_rows
+from sample_statistics import SampleStatistics, sampled_mode_tuples
+from sample_store import SampleStore, default_encoding
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--N', type=int, help='Total number of samples.')
@@ -12,6 +14,19 @@ parser.add_argument('--d', type=int, help='d for calculating the MPS before rand
 parser.add_argument('--dd', type=int, help='d for after random displacement. Maximum number of photons per mode that can be sampled - 1.')
 parser.add_argument('--chi', type=int, help='Bond dimension.')
 parser.add_argument('--dir', type=str, help="Root directory.", default=0)
+parser.add_argument('--mode', type=str, help="batch: sample n samples at a time through all sites. site: advance all N samples site by site, loading each Gamma once. pipeline: wavefront pipeline of --stages threads over contiguous groups of sites.", default='batch')
+parser.add_argument('--stages', type=int, help="Number of pipeline stages (threads) in pipeline mode.", default=4)
+parser.add_argument('--workers', type=int, help="Number of worker processes for batch mode.", default=1)
+parser.add_argument('--seed', type=int, help="Seed for reproducible sampling. Samples only depend on the seed (and N, n), not on the number of workers.", default=None)
+parser.add_argument('--clicks', action='store_true', help="Threshold detection: sample click patterns instead of photon numbers (batch mode). They are saved bit-packed to clicks_{i}.npy.")
+parser.add_argument('--eps', type=float, help="Adaptive cutoffs (batch mode): per sample and mode, the smallest cutoff up to dd whose photon-number tail is below eps.", default=None)
+parser.add_argument('--stats', action='store_true', help="Accumulate means, second moments and histograms of the samples while sampling, saved to statistics_{i}.npz.")
+parser.add_argument('--tuples', type=int, help="With --stats, also accumulate the third-order products of this many randomly chosen mode triples.", default=0)
+parser.add_argument('--store', action='store_true', help="Write the samples of iteration i to the compressed, sector-indexed store samples_{i}/ (clicks_{i}/) instead of a .npy file.")
+parser.add_argument('--modes', type=str, help="Sample only the marginal of these modes (batch mode), e.g. 0-9 or 3,5,8. Saved to samples_marginal_{i}.npy, with the mode indices in samples_marginal_modes.npy.", default=None)
+parser.add_argument('--sectors', type=str, help="Sector-targeted sampling (batch mode), e.g. 10-22: samples leaving this window of total photon (or click) numbers are dropped early. Saved to samples_sectors_{i}.npy.", default=None)
+parser.add_argument('--per_sector', type=int, help="With --sectors, number of samples to collect in every sector. Replaces --N.", default=None)
+parser.add_argument('--scratch', type=str, help="Directory for the memory-mapped buffers of site mode. Defaults to the MPS directory.", default=None)
 args = vars(parser.parse_args())
 
 N = args['N']
@@ -21,163 +36,140 @@ d = args['d']
 dd = args ['dd']
 chi = args['chi']
 rootdir = args['dir']
+mode = args['mode']
+scratch = args['scratch']
+workers = args['workers']
+stages = args['stages']
+seed = args['seed']
+clicks = args['clicks']
+eps = args['eps']
+stats = args['stats']
+tuples = args['tuples']
+store = args['store']
+modes = args['modes']
+sectors = args['sectors']
+per_sector = args['per_sector']
 
 def nothing_function(object):
     return object
 
-
-
-def sampling(path, dd, Lambda, sqrtW, samples_in_parallel, compare=False):
-    Gamma = np.load(path + f'Gamma_{0}.npy')
-    print('ChiL: {}, d: {}.'.format(Gamma.shape[0], Gamma.shape[2]))
-    d = Gamma.shape[2]
-    M = len(sqrtW) // 2
-    
-    print('Generating random displacements')
-    random_array = np.random.normal(size=(2 * M, samples_in_parallel))
-    
-    pure_mu = sqrtW @ random_array
-    pure_mu = pure_mu.T
-    pure_alpha = batch_mu_to_alpha(pure_mu, hbar=2)
-    displacements = batch_displaces(dd, pure_alpha)
-
-    np_res = []
-    res = []
-    #Sample
-    for i in tqdm(range(M)):
-        # if rank == 0:
-        #     print(i)
-        if i == 0:
-
-            random_thresholds = np.random.rand(samples_in_parallel, 1) # samples_in_parallel
-
-            probs = []
-            temp_tensor = np.zeros([chi, chi, dd], dtype='complex64')
-            temp_tensor[:, :, :d] = Gamma
-            temp_tensor = np.sum(temp_tensor, axis=0) # chi x cutoff
-            temp_tensor = np.einsum('mj,Bkj->Bmk', temp_tensor, displacements[:, i])
-            pre_tensor = np.copy(temp_tensor)
-            temp_tensor = np.abs(temp_tensor) ** 2
-            probs = [np.dot(temp_tensor[:, :, j], Lambda[:, 0] ** 2) for j in range(dd)]
-            probs = np.array(probs).T
-            probs = probs / np.sum(probs, axis=1)[:, np.newaxis]
-            cumulative_probs = np.cumsum(probs, axis=1)
-            random_thresholds = np.repeat(random_thresholds, dd, axis=1) # samples_in_parallel x cutoff
-            has_more_photons = random_thresholds > cumulative_probs # samples_in_parallel x cutoff
-            n_photons = np.sum(has_more_photons, axis=1)
-            res.append(n_photons)
-            batch_to_n_ph = np.zeros([samples_in_parallel, dd], dtype=int)
-            for n_ph in range(dd):
-                batch_to_n_ph[np.where(n_photons == n_ph)[0], n_ph] = 1
-            pre_tensor = np.einsum('BmP, BP -> Bm', pre_tensor, batch_to_n_ph)
+# Sorted mode indices from a specification like 0-9 or 3,5,8 (or 0-3,7)
+def parse_modes(spec, M):
+    modes = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            modes.extend(range(int(first), int(last) + 1))
         else:
-            probs = []
-            tensor = pre_tensor * Lambda[:, len(res) - 1] # samples_in_parallel x chi
-            Gamma = np.load(path + f'Gamma_{i}.npy')
-            Gamma_temp = np.zeros([chi, chi, dd], dtype='complex64')
-            Gamma_temp[:, :, :d] = Gamma
-            temp_tensor = np.copy(tensor) # samples_in_parallel x chi
-            temp_tensor = (temp_tensor @ Gamma_temp.reshape(chi, chi * dd)).reshape(samples_in_parallel, chi, dd)
-            temp_tensor = np.einsum('Bmj,Bkj->Bmk', temp_tensor, displacements[:, i])
-            pre_tensor = np.copy(temp_tensor)
-            temp_tensor = np.abs(temp_tensor) ** 2
-
-            for j in range(dd):
-
-                if len(res) == M - 1:
-                    probs.append(temp_tensor[:, 0, j])
-                else:
-                    probs.append(np.dot(temp_tensor[:, :, j], Lambda[:, len(res)] ** 2)); # appending shape samples_in_parallel
-            
-            random_thresholds = np.array(np.random.rand(samples_in_parallel, 1)) # samples_in_parallel
-
-            if compare:
-                np_probs = np.array(np_probs) / np.sum(np_probs);     
-                np_res.append(np.sum(np.cumsum(np_probs) < random_thresholds[0].item()))
-
-            probs = np.array(probs).T # samples_in_parallel x cutoff
-            probs = probs / np.sum(probs, axis=1)[:, np.newaxis] # samples_in_parallel x cutoff
-            cumulative_probs = np.cumsum(probs, axis=1) # samples_in_parallel x cutoff
-            random_thresholds = np.array(random_thresholds)
-            random_thresholds = np.repeat(random_thresholds, dd, axis=1) # samples_in_parallel x cutoff
-            has_more_photons = random_thresholds > cumulative_probs # samples_in_parallel x cutoff
-            n_photons = np.sum(has_more_photons, axis=1) # samples_in_parallel
-            res.append(n_photons)
-
-            if i == M - 1:
-                break
-            
-            batch_to_n_ph = np.zeros([samples_in_parallel, dd], dtype=int)
-            for n_ph in range(dd):
-                batch_to_n_ph[np.where(n_photons == n_ph)[0], n_ph] = 1
-            pre_tensor = np.einsum('BmP, BP -> Bm', pre_tensor, batch_to_n_ph)
-
-    results = np.array(res).T
-
-    return results
-
-
-def destroy(N):
-    data = np.sqrt(np.arange(1, N, dtype='complex64'))
-    return np.diag(data, 1);
-
-def displace(N, alpha): # N is the dim
-    a = destroy(N)
-    return expm(alpha * np.conj(a).T - np.conj(alpha) * a)
-
-def displaces(N, alphas): # N is the dim
-    a = destroy(N)
-    res = np.array([expm(alpha * np.conj(a).T - np.conj(alpha) * a) for alpha in alphas]);
-    return np.array(res)
-
-def batch_displaces(N, alphas): # N is the dim
-    samples_in_parallel = alphas.shape[0]
-    # alphas = alphas.reshape(-1, 1, 1)
-    M = alphas.shape[1]
-    a = destroy(N)
-    a_h = np.conj(a).T
-    a = np.repeat(a[np.newaxis], samples_in_parallel, axis=0)
-    a_h = np.repeat(a_h[np.newaxis], samples_in_parallel, axis=0)
-    results = []
-    for i in tqdm(range(M)):
-        alpha = alphas[:, i].reshape(-1, 1, 1)
-        # results.append(torch.linalg.matrix_exp(torch.tensor(alpha * a_h - np.conj(alpha) * a).cuda()).cpu().numpy())
-        results.append(expm(alpha * a_h - np.conj(alpha) * a))
-    results = np.transpose(np.array(results), (1, 0, 2, 3))
-    print(results.shape)
-    return results
-
-def mu_to_alpha(mu, hbar=2):
-    M = len(mu) // 2
-    # mean displacement of each mode
-    alpha = (mu[:M] + 1j * mu[M:]) / np.sqrt(2 * hbar)
-    return alpha
-
-def batch_mu_to_alpha(mu, hbar=2):
-    M = mu.shape[1] // 2
-    alpha = (mu[:, :M] + 1j * mu[:, M:]) / np.sqrt(2 * hbar)
-    return alpha
+            modes.append(int(part))
+    modes = np.unique(modes)
+    if modes[0] < 0 or modes[-1] >= M:
+        raise ValueError(f'Modes must be between 0 and {M - 1}.')
+    return modes
 
 
 
 if __name__ == "__main__":
     
     path = rootdir + f'd_{d}_chi_{chi}/'
+    if scratch is None:
+        scratch = path
     sq_cov = np.load(rootdir + "sq_cov.npy")
     cov = np.load(rootdir + "cov.npy")
-    thermal_cov = cov - sq_cov;
-    thermal_cov = thermal_cov + 1.000001 * np.eye(len(thermal_cov)) * np.abs(np.min(np.linalg.eigvalsh(thermal_cov)))
-    sqrtW = np.linalg.cholesky(thermal_cov)
+    sqrtW = get_sqrtW(cov, sq_cov)
     M = sqrtW.shape[0] // 2
-    Lambda = np.zeros([chi, M - 1], dtype='float32')
-    for i in range(M - 1):
-        Lambda[:, i] = np.load(path + f"Lambda_{i}.npy")
+    Lambda = load_Lambda(path, chi, M)
+    
+    Gammas = load_Gammas(path, M, mmap_mode='r')
+
+    if clicks and mode != 'batch':
+        raise ValueError('Click sampling is only available in batch mode.')
+    if eps is not None and (clicks or mode != 'batch'):
+        raise ValueError('Adaptive cutoffs are only available for photon-number sampling in batch mode.')
+    M_out = M
+    if modes is not None:
+        if mode != 'batch':
+            raise ValueError('Marginal sampling is only available in batch mode.')
+        modes = parse_modes(modes, M)
+        M_out = len(modes)
+    if sectors is not None:
+        if mode != 'batch':
+            raise ValueError('Sector-targeted sampling is only available in batch mode.')
+        sectors = tuple(int(N_sector) for N_sector in sectors.split('-'))
+        N = per_sector * (sectors[1] - sectors[0] + 1)
+
+    if seed is None and workers > 1:
+        seed = np.random.SeedSequence().entropy
+        print(f'Seed: {seed}') # Rerun with --seed to reproduce
     
     for i in range(iterations):
-        samples = np.zeros([0, M], dtype='int8')
-        for begin_batch in range(0, N, n):
-            end_batch = min(N, begin_batch + n)
-            samples_in_parallel = end_batch - begin_batch
-            subsamples = sampling(path, dd, Lambda, sqrtW, samples_in_parallel, False)
-            samples = np.concatenate([samples, subsamples], axis=0)
-            np.save(rootdir + f"samples_{i}.npy", samples)
\ No newline at end of file
+        # Resumes from the progress index if this iteration was interrupted
+        name = 'clicks' if clicks else 'samples'
+        if modes is not None:
+            name += '_marginal'
+            np.save(rootdir + f"{name}_modes.npy", modes)
+        if sectors is not None:
+            name += '_sectors'
+        if store:
+            writer = SampleStore(rootdir + f"{name}_{i}/", M_out, default_encoding(clicks, dd), N)
+        elif clicks:
+            writer = SampleWriter(rootdir + f"{name}_{i}.npy", (M_out + 7) // 8, N, dtype='uint8')
+        else:
+            writer = SampleWriter(rootdir + f"{name}_{i}.npy", M_out, N)
+
+        def written_samples(begin, end):
+            if store:
+                return writer.read(begin, end)
+            return unpack_clicks(writer.samples[begin:end], M_out) if clicks else writer.samples[begin:end]
+
+        statistics = None
+        if stats:
+            statistics = SampleStatistics(M_out, clicks, sampled_mode_tuples(M_out, tuples) if tuples > 0 else None)
+            for begin_batch in range(0, writer.count, n): # Rows written before an interruption
+                statistics.update(written_samples(begin_batch, min(writer.count, begin_batch + n)))
+
+        def save_chunk(chunk):
+            samples = unpack_clicks(chunk, M_out) if clicks else chunk
+            writer.append(samples if store else chunk)
+            if statistics is not None:
+                statistics.update(samples)
+
+        if sectors is not None and writer.count < N:
+            # Rounds of chunks until every sector has per_sector samples. Seeded chunks continue from the
+            # chunk after the last round, recorded in <name>_{i}_next_chunk.npy, so resuming never reuses a stream.
+            counts = np.zeros(sectors[1] + 1, dtype=np.int64)
+            for begin_batch in range(0, writer.count, n):
+                counts += np.bincount(written_samples(begin_batch, min(writer.count, begin_batch + n)).astype(np.int64).sum(axis=1), minlength=sectors[1] + 1)[:sectors[1] + 1]
+            next_chunk_file = rootdir + f"{name}_{i}_next_chunk.npy"
+            next_chunk = int(np.load(next_chunk_file)[0]) if os.path.isfile(next_chunk_file) else 0
+            rng = np.random if seed is None else None
+            round_chunks = 4 * workers
+            while writer.count < N:
+                if seed is None:
+                    chunks = sample_chunks(Gammas, dd, Lambda, sqrtW, round_chunks * n, n, rng, clicks, eps, modes, sectors)
+                else:
+                    chunks = parallel_sample_chunks(path, dd, Lambda, sqrtW, (next_chunk + round_chunks) * n, n, seed, i, workers, next_chunk, clicks, eps, modes, sectors)
+                for chunk in chunks:
+                    totals = (unpack_clicks(chunk, M_out) if clicks else chunk).astype(np.int64).sum(axis=1)
+                    rows = sector_quota_rows(totals, counts, sectors[0], sectors[1], per_sector)
+                    if len(rows) > 0:
+                        save_chunk(chunk[rows])
+                next_chunk += round_chunks
+                np.save(next_chunk_file, np.array([next_chunk]))
+                print('Samples per sector: {}'.format(counts[sectors[0]:]))
+
+        if sectors is None and writer.count < N:
+            rng = np.random if seed is None else np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i,)))
+            if mode == 'site':
+                chunks = [site_major_sampling(path, dd, Lambda, sqrtW, N - writer.count, n, scratch, rng)]
+            elif mode == 'pipeline':
+                chunks = pipelined_sample_chunks(Gammas, dd, Lambda, sqrtW, N - writer.count, n, stages, rng, seed=seed, iteration=i, first_chunk=writer.count // n)
+            elif seed is None:
+                chunks = sample_chunks(Gammas, dd, Lambda, sqrtW, N - writer.count, n, clicks=clicks, eps=eps, modes=modes)
+            else:
+                chunks = parallel_sample_chunks(path, dd, Lambda, sqrtW, N, n, seed, i, workers, writer.count // n, clicks, eps, modes)
+            for chunk in chunks:
+                save_chunk(chunk)
+
+        if statistics is not None:
+            statistics.save(rootdir + ("statistics_marginal" if modes is not None else "statistics") + f"_{i}.npz")
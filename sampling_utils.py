@@ -0,0 +1,602 @@
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+import os
+import multiprocessing
+import threading
+import queue
+
+complex_type = 'complex64'
+
+def destroy(N):
+    data = np.sqrt(np.arange(1, N, dtype='complex64'))
+    return np.diag(data, 1);
+
+# Displacement operator matrix elements <m|D(alpha)|n> for all alphas at once (any shape).
+# Uses the recurrence D[m, n] = (sqrt(m) D[m - 1, n - 1] - conj(alpha) D[m, n - 1]) / sqrt(n)
+# of the closed form in associated Laguerre polynomials, so the entries are exact up to the dim truncation
+# (unlike expm of the truncated generator), and cost O(dim^2) per alpha instead of a matrix exponential.
+def batch_displaces(dim, alphas, dtype=complex_type):
+    alphas = np.asarray(alphas, dtype='complex128')
+    shape = alphas.shape
+    alpha = alphas.reshape(1, -1)
+    alpha_c = np.conj(alpha)
+    sqrt = np.sqrt(np.arange(dim)).reshape(-1, 1)
+    # Built column by column as D[n, m, batch] so that each recurrence step works on contiguous rows
+    D = np.zeros([dim, dim, alpha.shape[1]], dtype='complex128')
+    D[0, 0] = np.exp(-np.abs(alpha[0]) ** 2 / 2)
+    for m in range(1, dim):
+        D[0, m] = alpha[0] / sqrt[m] * D[0, m - 1]
+    for n in range(1, dim):
+        D[n, 0] = -alpha_c[0] / sqrt[n] * D[n - 1, 0]
+        D[n, 1:] = (sqrt[1:] * D[n - 1, :-1] - alpha_c * D[n - 1, 1:]) / sqrt[n]
+    return np.ascontiguousarray(D.transpose(2, 1, 0), dtype=dtype).reshape(shape + (dim, dim))
+
+# Vacuum row <0|D(alpha)|j> = exp(-|alpha|^2 / 2) (-conj(alpha))^j / sqrt(j!) for j < dim, shape alphas.shape + (dim,)
+def vacuum_displacement_rows(dim, alphas, dtype=complex_type):
+    alphas = np.asarray(alphas, dtype='complex128')[..., np.newaxis]
+    j = np.arange(dim)
+    sqrt_factorial = np.sqrt(np.cumprod(np.maximum(j, 1)))
+    return (np.exp(-np.abs(alphas) ** 2 / 2) * (-np.conj(alphas)) ** j / sqrt_factorial).astype(dtype)
+
+# Photon-number tails T_c(r) = 1 - sum_{k < c} |<k|D(r)|j>|^2 of displaced Fock states on a grid of r = |alpha|,
+# shape grid_size x dd x d (index c - 1). They only depend on |alpha|. Each entry bounds the tail over the whole
+# grid cell ending at r, so looking up the next grid point above |alpha| gives an upper bound. With
+# G = a^dagger - a, T_c'' = -2 Re <psi|P_c G^2|psi> - 2 |P_c G psi|^2 is at most 16 (c + 1) in magnitude, so inside
+# a cell of width h the tail exceeds the larger endpoint by at most 2 (c + 1) h^2 (at a maximum inside the cell,
+# T_c' = 0 and the nearer endpoint is within h / 2). D is built chunk_size radii at a time to bound the memory.
+def displacement_tails(d, dd, grid_size=16384, chunk_size=4096):
+    radii = np.linspace(0, np.sqrt(dd) + 4, grid_size)
+    tails = np.empty([grid_size, dd, d])
+    for begin in range(0, grid_size, chunk_size):
+        D = batch_displaces(dd, radii[begin:begin + chunk_size], dtype='complex128')
+        tails[begin:begin + chunk_size] = np.maximum(1 - np.cumsum(np.abs(D[:, :, :d]) ** 2, axis=1), 0)
+    h = radii[1] - radii[0]
+    curvature = 2 * (np.arange(1, dd + 1) + 1) * h ** 2
+    tails[1:] = np.minimum(np.maximum(tails[1:], tails[:-1]) + curvature[:, np.newaxis], 1)
+    return radii, tails
+
+# Smallest cutoff (up to dd) for each sample whose truncation error is bounded by eps. state_probs[B, j] is the
+# probability of j photons before the displacement. By Cauchy-Schwarz, the tail of sum_j c_j D|j> is at most
+# d sum_j |c_j|^2 tail_j, so the bound only needs |alpha| and state_probs.
+# Beyond the grid there is no bound, and the cutoff is dd.
+def adaptive_cutoffs(radii, tails, alphas, state_probs, eps):
+    dd, d = tails.shape[1:]
+    index = np.searchsorted(radii, np.abs(alphas))
+    outside = index == len(radii)
+    bounds = d * np.einsum('Bcj,Bj->Bc', tails[np.minimum(index, len(radii) - 1)], state_probs)
+    enough = (bounds <= eps) & ~outside[:, np.newaxis]
+    return np.where(enough.any(axis=1), np.argmax(enough, axis=1) + 1, dd)
+
+def displace(N, alpha): # N is the dim
+    return batch_displaces(N, alpha)
+
+def mu_to_alpha(mu, hbar=2):
+    M = len(mu) // 2
+    # mean displacement of each mode
+    alpha = (mu[:M] + 1j * mu[M:]) / np.sqrt(2 * hbar)
+    return alpha
+
+def batch_mu_to_alpha(mu, hbar=2):
+    M = mu.shape[1] // 2
+    alpha = (mu[:, :M] + 1j * mu[:, M:]) / np.sqrt(2 * hbar)
+    return alpha
+
+def get_sqrtW(cov, sq_cov):
+    thermal_cov = cov - sq_cov;
+    thermal_cov = thermal_cov + 1.000001 * np.eye(len(thermal_cov)) * np.abs(np.min(np.linalg.eigvalsh(thermal_cov)))
+    return np.linalg.cholesky(thermal_cov)
+
+def load_Lambda(path, chi, M):
+    Lambda = np.zeros([chi, M - 1], dtype='float32')
+    for i in range(M - 1):
+        Lambda[:, i] = np.load(path + f"Lambda_{i}.npy")
+    return Lambda
+
+# Gamma tensors of all sites. With mmap_mode='r' they are memory mapped and only read when used.
+def load_Gammas(path, M, mmap_mode=None):
+    return [np.load(path + f'Gamma_{i}.npy', mmap_mode=mmap_mode) for i in range(M)]
+
+def load_Gamma(path, i):
+    return np.load(path + f'Gamma_{i}.npy')
+
+# Samples the photon number of one site for a batch of samples.
+# pre_tensor is the boundary vector from the previous site (None for the first site),
+# Lambda_right is None for the last site. step returns the sampled photon numbers and the next boundary vector.
+# All intermediate arrays live in workspaces that are allocated once per batch shape, and the returned
+# boundary vector is one of them: it is valid until the next step with the same shape, so copy it to keep it.
+# Gamma is the unpadded chi x chi x d tensor, only the first d columns of the displacements are used.
+class SiteStepper:
+
+    def __init__(self, max_workspaces=16):
+        self.workspaces = {}
+        self.max_workspaces = max_workspaces
+
+    def workspace(self, samples_in_parallel, chi_left, chi_right, d, dd):
+        key = (samples_in_parallel, chi_left, chi_right, d, dd)
+        if key not in self.workspaces:
+            if len(self.workspaces) >= self.max_workspaces:
+                del self.workspaces[next(iter(self.workspaces))] # Oldest shape, e.g. of a previous bucket size
+            rows = np.arange(samples_in_parallel)
+            self.workspaces[key] = {
+                'tensor': np.empty([samples_in_parallel, chi_left], dtype=complex_type),
+                'contracted': np.empty([samples_in_parallel, chi_right, d], dtype=complex_type),
+                'amplitudes': np.empty([samples_in_parallel, chi_right, dd], dtype=complex_type),
+                'weights': np.empty([samples_in_parallel, chi_right, dd], dtype='float32'),
+                'probs': np.empty([samples_in_parallel, dd], dtype='float32'),
+                'cumulative_probs': np.empty([samples_in_parallel, dd], dtype='float32'),
+                'has_more_photons': np.empty([samples_in_parallel, dd], dtype=bool),
+                'n_photons': np.empty(samples_in_parallel, dtype=np.int64),
+                # Flat index of amplitudes[B, m, 0], the sampled photon number is added for the gather
+                'base_index': (rows[:, np.newaxis] * chi_right * dd + np.arange(chi_right) * dd),
+                'index': np.empty([samples_in_parallel, chi_right], dtype=np.int64),
+                'norms': np.empty(samples_in_parallel, dtype='float32'),
+                'boundary': np.empty([samples_in_parallel, chi_right], dtype=complex_type),
+                'rows': rows,
+            }
+        return self.workspaces[key]
+
+    def step(self, pre_tensor, Lambda_left, Gamma, displacements, Lambda_right, random_thresholds):
+        samples_in_parallel, dd, _ = displacements.shape
+        chi_left, chi_right, d = Gamma.shape
+        ws = self.workspace(samples_in_parallel, chi_left, chi_right, d, dd)
+        return self.outcomes(ws, self.contract(ws, pre_tensor, Lambda_left, Gamma), displacements, Lambda_right, random_thresholds)
+
+    # contracted[B, m, j]: the state of the site before the displacement, samples_in_parallel x chi_right x d
+    def contract(self, ws, pre_tensor, Lambda_left, Gamma):
+        chi_left, chi_right, d = Gamma.shape
+        contracted = ws['contracted']
+        if pre_tensor is None:
+            contracted[:] = np.sum(Gamma, axis=0)
+        else:
+            np.multiply(pre_tensor, Lambda_left, out=ws['tensor'])
+            np.matmul(ws['tensor'], Gamma.reshape(chi_left, chi_right * d), out=contracted.reshape(-1, chi_right * d))
+        return contracted
+
+    def outcomes(self, ws, contracted, displacements, Lambda_right, random_thresholds):
+        samples_in_parallel, chi_right, d = contracted.shape
+        dd = displacements.shape[1]
+        # amplitudes[B, m, k] = sum_j contracted[B, m, j] D[B, k, j] for j < d
+        np.matmul(contracted, displacements[:, :, :d].transpose(0, 2, 1), out=ws['amplitudes'])
+
+        # probs[B, k] = sum_m Lambda_right[m] ** 2 |amplitudes[B, m, k]| ** 2
+        weights = ws['weights']
+        np.abs(ws['amplitudes'], out=weights)
+        np.square(weights, out=weights)
+        probs = ws['probs']
+        if Lambda_right is None:
+            probs[:] = weights[:, 0]
+        else:
+            np.matmul(Lambda_right ** 2, weights, out=probs)
+
+        # Inverse CDF: the photon number is the number of cumulative probabilities below the threshold
+        cumulative_probs = ws['cumulative_probs']
+        np.cumsum(probs, axis=1, out=cumulative_probs)
+        np.multiply(random_thresholds.reshape(-1, 1), cumulative_probs[:, -1:], out=ws['norms'].reshape(-1, 1))
+        np.less(cumulative_probs, ws['norms'].reshape(-1, 1), out=ws['has_more_photons'])
+        n_photons = ws['n_photons']
+        np.sum(ws['has_more_photons'], axis=1, out=n_photons)
+        np.minimum(n_photons, dd - 1, out=n_photons) # Rounding can leave the threshold above the last cumulative probability
+
+        if Lambda_right is None:
+            return n_photons, None
+
+        # Gathers amplitudes[B, :, n_photons[B]] and normalizes it, which keeps the boundary vectors from underflowing
+        index = ws['index']
+        np.add(ws['base_index'], n_photons[:, np.newaxis], out=index)
+        boundary = ws['boundary']
+        np.take(ws['amplitudes'].reshape(-1), index, out=boundary)
+        norms = ws['norms']
+        np.sqrt(probs[ws['rows'], n_photons], out=norms)
+        boundary /= norms[:, np.newaxis]
+        return n_photons, boundary
+
+    # Samples with a per-sample cutoff from adaptive_cutoffs instead of a global dd. Samples are bucketed by
+    # cutoff and each bucket runs with its own narrow displacement matrices and probability vectors. The
+    # matrices are c x d blocks <k|D|j> (k < c, j < d), also for cutoffs c below d, e.g. for near-vacuum modes.
+    # Also returns the cutoffs and the truncation error of each sample, the probability outside its cutoff.
+    def adaptive_step(self, pre_tensor, Lambda_left, Gamma, alphas, tails, eps, Lambda_right, random_thresholds):
+        samples_in_parallel = len(alphas)
+        chi_left, chi_right, d = Gamma.shape
+        contracted = self.contract(self.workspace(samples_in_parallel, chi_left, chi_right, d, d), pre_tensor, Lambda_left, Gamma)
+        if Lambda_right is None:
+            Lambda_weights = np.zeros(chi_right, dtype='float32')
+            Lambda_weights[0] = 1
+        else:
+            Lambda_weights = Lambda_right ** 2
+        # D(alpha) is unitary, so the total probability is the weighted norm before the displacement
+        state_probs = Lambda_weights @ np.abs(contracted) ** 2 # samples_in_parallel x d
+        total_probs = np.sum(state_probs, axis=1)
+        cutoffs = adaptive_cutoffs(*tails, alphas, state_probs / total_probs[:, np.newaxis], eps)
+        n_photons = np.empty(samples_in_parallel, dtype=np.int64)
+        boundary = None if Lambda_right is None else np.empty([samples_in_parallel, chi_right], dtype=complex_type)
+        kept_probs = np.empty(samples_in_parallel, dtype='float32')
+        for dd in np.unique(cutoffs):
+            rows = np.flatnonzero(cutoffs == dd)
+            ws = self.workspace(len(rows), chi_left, chi_right, d, dd)
+            displacements = batch_displaces(max(dd, d), alphas[rows])[:, :dd, :d]
+            n_photons[rows], bucket_boundary = self.outcomes(ws, contracted[rows], displacements, Lambda_right, random_thresholds[rows])
+            kept_probs[rows] = ws['cumulative_probs'][:, -1]
+            if boundary is not None:
+                boundary[rows] = bucket_boundary
+        return n_photons, boundary, cutoffs, np.maximum(1 - kept_probs / total_probs, 0)
+
+    # Threshold detection: returns whether each sample clicked, and the next boundary vector.
+    # D(alpha) is unitary, so the total probability is the weighted norm of the contracted state before the
+    # displacement, and p(no click) only needs the vacuum row of D. Only the clicked samples resolve the
+    # photon number, from the distribution conditioned on at least one photon, which keeps their boundary
+    # vectors pure. The threshold is rescaled, so the photon number is the one step would have sampled.
+    def click_step(self, pre_tensor, Lambda_left, Gamma, alphas, dd, Lambda_right, random_thresholds):
+        samples_in_parallel = len(alphas)
+        chi_left, chi_right, d = Gamma.shape
+        ws = self.workspace(samples_in_parallel, chi_left, chi_right, d, dd)
+        contracted = self.contract(ws, pre_tensor, Lambda_left, Gamma)
+        if Lambda_right is None:
+            Lambda_weights = np.zeros(chi_right, dtype='float32')
+            Lambda_weights[0] = 1
+        else:
+            Lambda_weights = Lambda_right ** 2
+
+        weights = ws['weights'][:, :, :d]
+        np.abs(contracted, out=weights)
+        np.square(weights, out=weights)
+        total_probs = np.sum(weights, axis=2) @ Lambda_weights
+        vacuum = ws['amplitudes'][:, :, :1]
+        np.matmul(contracted, vacuum_displacement_rows(d, alphas)[:, :, np.newaxis], out=vacuum)
+        vacuum_probs = np.abs(vacuum[:, :, 0]) ** 2 @ Lambda_weights
+        random_thresholds = random_thresholds.reshape(-1)
+        clicks = random_thresholds * total_probs >= vacuum_probs
+
+        if Lambda_right is None:
+            return clicks, None
+
+        boundary = ws['boundary']
+        np.divide(vacuum[:, :, 0], np.sqrt(vacuum_probs)[:, np.newaxis], out=boundary)
+        clicked = np.flatnonzero(clicks)
+        if len(clicked) > 0:
+            displacements = batch_displaces(dd, alphas[clicked])[:, :, :d].transpose(0, 2, 1)
+            amplitudes = contracted[clicked] @ displacements
+            probs = Lambda_weights @ np.abs(amplitudes) ** 2
+            probs[:, 0] = 0
+            cumulative_probs = np.cumsum(probs, axis=1)
+            p_vacuum = vacuum_probs[clicked] / total_probs[clicked]
+            conditional_thresholds = (random_thresholds[clicked] - p_vacuum) / (1 - p_vacuum) * cumulative_probs[:, -1]
+            n_photons = np.sum(cumulative_probs < conditional_thresholds[:, np.newaxis], axis=1)
+            n_photons = np.clip(n_photons, 1, dd - 1)
+            rows = np.arange(len(clicked))
+            boundary[clicked] = amplitudes[rows, :, n_photons] / np.sqrt(probs[rows, n_photons])[:, np.newaxis]
+        return clicks, boundary
+
+# Samples a batch of samples_in_parallel samples through all sites (batch-major).
+# rng is np.random (global state) or a np.random.Generator.
+# With clicks=True, returns the click patterns packed into bits along the modes (see unpack_clicks).
+# With eps, the cutoff of each sample and site is the smallest one (up to dd) with a photon-number tail below eps.
+# With modes (sorted), only the marginal of these modes is sampled and returned. Modes after the last one are
+# traced out by the Lambda weights, modes before the first one by starting from a Schmidt index drawn with
+# probabilities Lambda^2, so only the sites from the first to the last requested mode are run.
+# Modes in between are sampled but not returned.
+# With sector = (low, high), only the samples whose total photon (or click) number over the returned modes is in
+# [low, high] are returned. Samples are dropped as soon as their running total leaves the window (or cannot reach
+# it anymore), and the batch is compacted so that the remaining sites only process the surviving samples.
+def sampling(Gammas, dd, Lambda, sqrtW, samples_in_parallel, rng=np.random, clicks=False, eps=None, modes=None, sector=None):
+    print('ChiL: {}, d: {}.'.format(Gammas[0].shape[0], Gammas[0].shape[2]))
+    M = len(sqrtW) // 2
+    sites = np.arange(M) if modes is None else np.arange(modes[0], modes[-1] + 1)
+
+    print('Generating random displacements')
+    random_array = rng.normal(size=(2 * M, samples_in_parallel))
+
+    pure_mu = sqrtW[np.concatenate([sites, sites + M])] @ random_array # Only the rows of the sites that are run
+    pure_mu = pure_mu.T
+    pure_alpha = batch_mu_to_alpha(pure_mu, hbar=2)
+
+    results = np.zeros([samples_in_parallel, len(sites)], dtype=np.int64)
+    active = np.arange(samples_in_parallel)
+    totals = np.zeros(samples_in_parallel, dtype=np.int64)
+    counted = np.ones(len(sites), dtype=bool) if modes is None else np.isin(sites, modes)
+    counted_after = np.cumsum(counted[::-1])[::-1] - counted # Number of counted sites after each site
+    max_outcome = 1 if clicks else dd - 1
+    pre_tensor = None
+    if sites[0] > 0:
+        schmidt_probs = np.cumsum(Lambda[:, sites[0] - 1].astype('float64') ** 2)
+        schmidt_index = np.searchsorted(schmidt_probs, rng.random(samples_in_parallel) * schmidt_probs[-1], side='right')
+        schmidt_index = np.minimum(schmidt_index, len(schmidt_probs) - 1)
+        pre_tensor = np.zeros([samples_in_parallel, Lambda.shape[0]], dtype=complex_type)
+        pre_tensor[np.arange(samples_in_parallel), schmidt_index] = 1
+    stepper = SiteStepper()
+    if eps is not None:
+        tails = displacement_tails(Gammas[0].shape[2], dd)
+        cutoffs = np.zeros([samples_in_parallel, len(sites)], dtype='int8')
+        truncation_errors = np.zeros([samples_in_parallel, len(sites)], dtype='float32')
+    for site, i in enumerate(tqdm(sites)):
+        Gamma = Gammas[i]
+        random_thresholds = rng.random((len(active), 1)) # samples_in_parallel
+        Lambda_left = Lambda[:, i - 1] if i > 0 else None
+        Lambda_right = Lambda[:, i] if i < M - 1 else None
+        alphas = pure_alpha[:, site] if sector is None else pure_alpha[active, site]
+        if clicks:
+            outcomes, pre_tensor = stepper.click_step(pre_tensor, Lambda_left, Gamma, alphas, dd, Lambda_right, random_thresholds)
+        elif eps is not None:
+            outcomes, pre_tensor, cutoffs[active, site], truncation_errors[active, site] = stepper.adaptive_step(pre_tensor, Lambda_left, Gamma, alphas, tails, eps, Lambda_right, random_thresholds)
+        else:
+            displacements = batch_displaces(dd, alphas) # Only this site's displacements are kept in memory
+            outcomes, pre_tensor = stepper.step(pre_tensor, Lambda_left, Gamma, displacements, Lambda_right, random_thresholds)
+        results[active, site] = outcomes
+        if sector is not None and counted[site]:
+            totals += outcomes
+            keep = (totals <= sector[1]) & (totals + counted_after[site] * max_outcome >= sector[0])
+            if not keep.all():
+                active = active[keep]
+                totals = totals[keep]
+                if pre_tensor is not None:
+                    pre_tensor = pre_tensor[keep]
+            if len(active) == 0:
+                break
+
+    results = results[active]
+    if modes is not None:
+        results = results[:, np.asarray(modes) - sites[0]]
+    if eps is not None:
+        print('Mean cutoff {:.2f}, truncation error per site: mean {:.2e}, max {:.2e}.'.format(
+            cutoffs[cutoffs > 0].mean(), truncation_errors[cutoffs > 0].mean(), truncation_errors.max()))
+    if clicks:
+        return np.packbits(results, axis=1)
+
+    return results
+
+# Rows of samples to keep so that each sector of total photon (or click) number in [low, high] gets at most quota
+# samples. counts holds the number of samples kept so far per sector and is updated.
+def sector_quota_rows(totals, counts, low, high, quota):
+    rows = []
+    for N in range(low, high + 1):
+        sector_rows = np.flatnonzero(totals == N)[:max(quota - counts[N], 0)]
+        counts[N] += len(sector_rows)
+        rows.append(sector_rows)
+    return np.sort(np.concatenate(rows))
+
+# (samples, M) 0/1 click patterns from the bit-packed output of click sampling
+def unpack_clicks(packed, M):
+    return np.unpackbits(packed, axis=1, count=M)
+
+# Yields the samples in chunks of n, each an (n, M) int8 array, from an MPS loaded with load_Gammas.
+# With clicks=True the chunks are (n, ceil(M / 8)) uint8 packed click patterns.
+def sample_chunks(Gammas, dd, Lambda, sqrtW, N, n, rng=np.random, clicks=False, eps=None, modes=None, sector=None):
+    for begin_batch in range(0, N, n):
+        end_batch = min(N, begin_batch + n)
+        samples = sampling(Gammas, dd, Lambda, sqrtW, end_batch - begin_batch, rng, clicks, eps, modes, sector)
+        yield samples if clicks else samples.astype('int8')
+
+# Independent random stream of one chunk of samples. Streams are spawned per (iteration, chunk) from the
+# seed, so the samples only depend on the seed, and not on the number of workers or which worker ran a chunk.
+def chunk_rng(seed, iteration, chunk_id):
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(iteration, chunk_id)))
+
+# Counter-based streams of the MPI sampler. Every rank reproduces the random numbers of a batch without
+# communication: the Philox key comes from the seed and the counter from (iteration, batch, stream), so the
+# streams of different batches never overlap and do not depend on the number of ranks or replicas.
+# Stream 0 holds the standard normals of the displacements, stream 1 + site the thresholds of a site.
+def philox_rng(seed, iteration, batch, stream=0):
+    key = np.random.SeedSequence(seed).generate_state(2, np.uint64)
+    return np.random.Generator(np.random.Philox(key=key, counter=[0, stream, batch, iteration]))
+
+# alphas (samples_in_parallel x len(sites)) of batch, computing only the rows of sqrtW of these sites
+def batch_alphas(sqrtW, sites, seed, iteration, batch, samples_in_parallel):
+    M = sqrtW.shape[0] // 2
+    random_array = philox_rng(seed, iteration, batch).standard_normal((2 * M, samples_in_parallel))
+    pure_mu = sqrtW[np.concatenate([sites, sites + M])] @ random_array
+    return batch_mu_to_alpha(pure_mu.T, hbar=2)
+
+worker_state = {}
+
+def init_sampling_worker(path, M, dd, Lambda, sqrtW, clicks=False, eps=None, modes=None, sector=None):
+    # Gammas are memory mapped read-only, so all workers share the page cache instead of holding copies
+    worker_state['Gammas'] = load_Gammas(path, M, mmap_mode='r')
+    worker_state['dd'] = dd
+    worker_state['Lambda'] = Lambda
+    worker_state['sqrtW'] = sqrtW
+    worker_state['clicks'] = clicks
+    worker_state['eps'] = eps
+    worker_state['modes'] = modes
+    worker_state['sector'] = sector
+
+def sample_seeded_chunk(task):
+    seed, iteration, chunk_id, samples_in_parallel = task
+    rng = chunk_rng(seed, iteration, chunk_id)
+    samples = sampling(worker_state['Gammas'], worker_state['dd'], worker_state['Lambda'], worker_state['sqrtW'], samples_in_parallel, rng, worker_state['clicks'], worker_state['eps'], worker_state['modes'], worker_state['sector'])
+    return samples if worker_state['clicks'] else samples.astype('int8')
+
+# Like sample_chunks, but reproducible from seed and sharded over a pool of worker processes.
+# Chunks are yielded in order, starting from chunk first_chunk (to resume an interrupted iteration).
+def parallel_sample_chunks(path, dd, Lambda, sqrtW, N, n, seed, iteration=0, workers=1, first_chunk=0, clicks=False, eps=None, modes=None, sector=None):
+    M = len(sqrtW) // 2
+    tasks = [(seed, iteration, chunk_id, min(N, (chunk_id + 1) * n) - chunk_id * n) for chunk_id in range(first_chunk, (N + n - 1) // n)]
+    if workers == 1:
+        init_sampling_worker(path, M, dd, Lambda, sqrtW, clicks, eps, modes, sector)
+        for task in tasks:
+            yield sample_seeded_chunk(task)
+        return
+    with multiprocessing.Pool(workers, initializer=init_sampling_worker, initargs=(path, M, dd, Lambda, sqrtW, clicks, eps, modes, sector)) as pool:
+        for chunk in pool.imap(sample_seeded_chunk, tasks):
+            yield chunk
+
+# Wavefront pipeline on one node, the single-node analogue of distributed_sampling.py.
+# Sites are split into contiguous stages, each run by a thread that keeps its Gammas resident.
+# While stage s works on batch b, stage s + 1 works on batch b - 1; boundary vectors are passed through
+# bounded queues. The randomness of a batch is drawn up front in the same order as sampling, so for the
+# same rng the samples are identical to sample_chunks.
+def pipelined_sample_chunks(Gammas, dd, Lambda, sqrtW, N, n, stages, rng=np.random, queue_size=2, seed=None, iteration=0, first_chunk=0):
+    M = len(sqrtW) // 2
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(stages + 1)]
+
+    # With seed, every chunk draws from chunk_rng like parallel_sample_chunks (in the same order as sampling),
+    # so the samples do not depend on the mode, and a resumed run (first_chunk > 0) continues the same streams
+    def producer():
+        try:
+            for chunk_id, begin_batch in enumerate(range(0, N, n), first_chunk):
+                samples_in_parallel = min(N, begin_batch + n) - begin_batch
+                chunk_random = rng if seed is None else chunk_rng(seed, iteration, chunk_id)
+                random_array = chunk_random.normal(size=(2 * M, samples_in_parallel))
+                pure_alpha = batch_mu_to_alpha((sqrtW @ random_array).T, hbar=2)
+                random_thresholds = chunk_random.random((M, samples_in_parallel))
+                n_photons = np.zeros([samples_in_parallel, M], dtype='int8')
+                queues[0].put((None, pure_alpha, random_thresholds, n_photons))
+        except Exception as e:
+            queues[0].put(e) # Passed on by the stages, so that the consumer raises it instead of waiting
+        queues[0].put(None)
+
+    def stage(sites, in_queue, out_queue):
+        Gamma_stage = {i: np.array(Gammas[i]) for i in sites} # Resident copies, also of memory-mapped Gammas
+        stepper = SiteStepper()
+        failed = False
+        while True:
+            item = in_queue.get()
+            if item is None or isinstance(item, Exception):
+                out_queue.put(item)
+                if item is None:
+                    return
+                failed = True
+                continue
+            if failed:
+                continue # Keep draining so that earlier stages never block
+            try:
+                pre_tensor, pure_alpha, random_thresholds, n_photons = item
+                for i in sites:
+                    displacements = batch_displaces(dd, pure_alpha[:, i])
+                    Lambda_left = Lambda[:, i - 1] if i > 0 else None
+                    Lambda_right = Lambda[:, i] if i < M - 1 else None
+                    n_photons[:, i], pre_tensor = stepper.step(pre_tensor, Lambda_left, Gamma_stage[i], displacements, Lambda_right, random_thresholds[i].reshape(-1, 1))
+                if pre_tensor is not None:
+                    pre_tensor = pre_tensor.copy() # The stepper reuses its buffer for the next batch
+                out_queue.put((pre_tensor, pure_alpha, random_thresholds, n_photons))
+            except Exception as e:
+                out_queue.put(e)
+                failed = True
+
+    threads = [threading.Thread(target=producer, daemon=True)]
+    for stage_id, sites in enumerate(np.array_split(np.arange(M), stages)):
+        threads.append(threading.Thread(target=stage, args=(sites, queues[stage_id], queues[stage_id + 1]), daemon=True))
+    for thread in threads:
+        thread.start()
+    while True:
+        item = queues[-1].get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item[3]
+
+# Samples N samples site by site (site-major): every Gamma is read from disk once,
+# and all N samples are advanced through a site before moving on to the next one.
+# Boundary vectors and displacements of all samples are kept in memory-mapped buffers under scratch,
+# and Gamma_{i+1} is loaded on a background thread while site i is computed.
+def site_major_sampling(path, dd, Lambda, sqrtW, N, n, scratch, rng=np.random):
+    M = len(sqrtW) // 2
+    chi = Lambda.shape[0]
+
+    print('Generating random displacements')
+    pure_alpha = np.lib.format.open_memmap(scratch + 'pure_alpha.npy', mode='w+', dtype='complex64', shape=(M, N)) # site-major for contiguous reads
+    for begin_batch in range(0, N, n):
+        end_batch = min(N, begin_batch + n)
+        random_array = rng.normal(size=(2 * M, end_batch - begin_batch))
+        pure_mu = (sqrtW @ random_array).T
+        pure_alpha[:, begin_batch : end_batch] = batch_mu_to_alpha(pure_mu, hbar=2).T
+    boundary = np.lib.format.open_memmap(scratch + 'boundary.npy', mode='w+', dtype='complex64', shape=(N, chi))
+    samples = np.zeros([N, M], dtype='int8')
+    stepper = SiteStepper()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(load_Gamma, path, 0)
+        for i in tqdm(range(M)):
+            Gamma = future.result()
+            if i + 1 < M:
+                future = executor.submit(load_Gamma, path, i + 1) # Prefetch while this site computes
+            Lambda_left = Lambda[:, i - 1] if i > 0 else None
+            Lambda_right = Lambda[:, i] if i < M - 1 else None
+            for begin_batch in range(0, N, n):
+                end_batch = min(N, begin_batch + n)
+                samples_in_parallel = end_batch - begin_batch
+                pre_tensor = boundary[begin_batch : end_batch] if i > 0 else None
+                displacements = batch_displaces(dd, pure_alpha[i, begin_batch : end_batch])
+                random_thresholds = rng.random((samples_in_parallel, 1))
+                n_photons, pre_tensor = stepper.step(pre_tensor, Lambda_left, Gamma, displacements, Lambda_right, random_thresholds)
+                samples[begin_batch : end_batch, i] = n_photons
+                if pre_tensor is not None:
+                    boundary[begin_batch : end_batch] = pre_tensor
+
+    del pure_alpha, boundary
+    os.remove(scratch + 'pure_alpha.npy')
+    os.remove(scratch + 'boundary.npy')
+    return samples
+
+def progress_file(file):
+    return file[:-len('.npy')] + '_progress.npy'
+
+# Number of sample rows of file that have been written, according to its progress index
+def written_rows(file):
+    if not os.path.isfile(progress_file(file)):
+        return 0
+    return int(np.load(progress_file(file))[0])
+
+def save_written_rows(file, count):
+    temp_file = progress_file(file) + '.tmp'
+    with open(temp_file, 'wb') as f:
+        np.save(f, np.array([count], dtype='int64'))
+    os.replace(temp_file, progress_file(file))
+
+# The rows of a sample file written so far, memory mapped. Can be called while sampling is still running.
+def load_written_samples(file):
+    return np.load(file, mmap_mode='r')[:written_rows(file)]
+
+# Append-only writer of an (rows, M) sample file (int8 photon numbers, or uint8 packed clicks). The file is preallocated to capacity rows as a
+# memory-mapped .npy file and extended in place if more rows are appended, so writing N samples costs O(N) I/O.
+# After every chunk the number of rows written is recorded in <file>_progress.npy, which lets readers
+# consume finished chunks during sampling, and lets an interrupted run resume where it stopped.
+class SampleWriter:
+
+    def __init__(self, file, M, capacity, dtype='int8'):
+        self.file = file
+        self.count = written_rows(file)
+        if self.count > 0 and os.path.isfile(file):
+            self.samples = np.load(file, mmap_mode='r+')
+            if capacity > self.samples.shape[0]:
+                self.extend(capacity)
+        else:
+            self.count = 0
+            self.samples = np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=(capacity, M))
+            self.save_progress()
+
+    def save_progress(self):
+        save_written_rows(self.file, self.count)
+
+    # Grows the file to capacity rows. The .npy header reserves space for the shape to grow, so only
+    # the header is rewritten and the existing rows are not copied.
+    def extend(self, capacity):
+        M = self.samples.shape[1]
+        dtype = self.samples.dtype
+        self.samples.flush()
+        del self.samples
+        with open(self.file, 'r+b') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                np.lib.format.read_array_header_1_0(f)
+            else:
+                np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+            f.seek(0)
+            header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (capacity, M)}
+            if version == (1, 0):
+                np.lib.format.write_array_header_1_0(f, header)
+            else:
+                np.lib.format.write_array_header_2_0(f, header)
+            assert f.tell() == offset
+            f.truncate(offset + capacity * M * dtype.itemsize)
+        self.samples = np.load(self.file, mmap_mode='r+')
+
+    def append(self, chunk):
+        end = self.count + chunk.shape[0]
+        if end > self.samples.shape[0]:
+            self.extend(max(end, 2 * self.samples.shape[0]))
+        self.samples[self.count : end] = chunk
+        self.samples.flush() # Data must be on disk before the progress index says so
+        self.count = end
+        self.save_progress()
@@ -0,0 +1,48 @@
+import numpy as np
+
+# Assignment of the M sites (optical modes) to the ranks of the MPI programs. Every rank owns a contiguous block
+# of sites, so any number of ranks can be used. distributed_kron.py, distributed_MPS.py and distributed_sampling.py
+# must use the same partition, since each stage reads the files of the previous one from its node's local scratch.
+
+# Relative cost of a site in MPS construction and sampling: chi^2 for the middle sites, chi for the two end sites
+# whose Gamma tensors only have one nonzero row or column.
+def site_costs(M, chi):
+    costs = np.full(M, float(chi) ** 2)
+    costs[0] = chi
+    costs[-1] = chi
+    return costs
+
+# Sites in blocks of at most limit total cost, filled greedily. Returns the first site of each block.
+def greedy_blocks(costs, limit):
+    starts = [0]
+    total = 0
+    for site, cost in enumerate(costs):
+        if total + cost > limit and total > 0:
+            starts.append(site)
+            total = 0
+        total += cost
+    return starts
+
+# Contiguous blocks of sites for ranks ranks, minimizing the largest block cost by bisection on the
+# greedy limit. Returns bounds (ranks + 1): rank r owns sites bounds[r] to bounds[r + 1] - 1.
+# If there are more ranks than sites, the last ranks own no sites.
+def partition_sites(costs, ranks, iterations=60):
+    costs = np.asarray(costs, dtype=float)
+    low, high = costs.max(), costs.sum()
+    for _ in range(iterations):
+        limit = (low + high) / 2
+        if len(greedy_blocks(costs, limit)) <= ranks:
+            high = limit
+        else:
+            low = limit
+    starts = greedy_blocks(costs, high)
+    bounds = np.full(ranks + 1, len(costs), dtype=np.int64)
+    bounds[:len(starts)] = starts
+    return bounds
+
+def rank_sites(bounds, rank):
+    return np.arange(bounds[rank], bounds[rank + 1])
+
+# Rank that owns site
+def site_owner(bounds, site):
+    return int(np.searchsorted(bounds, site, side='right') - 1)
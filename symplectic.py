@@ -0,0 +1,142 @@
+import numpy as np
+from scipy.linalg import sqrtm, svd
+import hashlib
+import os
+
+# Symplectic decompositions shared by the kron, MPS and sampling stages.
+# The cached_* functions store results on disk keyed by a hash of the input matrix,
+# so every decomposition is computed only once per experiment, across stages and reruns.
+
+def sympmat(N, dtype=np.float64):
+    I = np.identity(N, dtype=dtype)
+    O = np.zeros_like(I, dtype=dtype)
+    S = np.block([[O, I], [-I, O]])
+    return S
+
+def xpxp_to_xxpp(S):
+    shape = S.shape
+    n = shape[0]
+
+    if n % 2 != 0:
+        raise ValueError("The input array is not even-dimensional")
+
+    n = n // 2
+    ind = np.arange(2 * n).reshape(-1, 2).T.flatten()
+
+    if len(shape) == 2:
+        if shape[0] != shape[1]:
+            raise ValueError("The input matrix is not square")
+        return S[:, ind][ind]
+
+    return S[ind]
+
+def williamson(V, tol=1e-11):
+    (n, m) = V.shape
+
+    if n != m:
+        raise ValueError("The input matrix is not square")
+
+    diffn = np.linalg.norm(V - np.transpose(V))
+
+    if diffn >= tol:
+        raise ValueError("The input matrix is not symmetric")
+
+    if n % 2 != 0:
+        raise ValueError("The input matrix must have an even number of rows/columns")
+
+    n = n // 2
+    omega = sympmat(n)
+    vals, Q = np.linalg.eigh(V)
+
+    if (vals <= 0).any():
+        raise ValueError("Input matrix is not positive definite")
+
+    # V^(-1/2) and V^(1/2) from one eigendecomposition instead of sqrtm(inv(V))
+    Mm12 = (Q / np.sqrt(vals)) @ Q.T
+    M12 = (Q * np.sqrt(vals)) @ Q.T
+    r1 = Mm12 @ omega @ Mm12
+    # r1 is antisymmetric, so 1j * r1 is Hermitian with eigenvalues +-1/nu.
+    # For an eigenvector u = x + iy of a positive eigenvalue lam, r1 @ x = lam * y and r1 @ y = -lam * x,
+    # which gives the real Schur vectors with the orientation the schur-based version flips into.
+    lam, u = np.linalg.eigh(1j * r1)
+    lam = lam[n:]
+    u = u[:, n:]
+    Ktt = np.sqrt(2) * np.concatenate([u.imag, u.real], axis=1)
+    Db = np.diag(np.concatenate([1 / lam, 1 / lam]))
+    # inv(Mm12 @ Ktt @ sqrt(Db)).T, using that Ktt is orthogonal
+    return Db, M12 @ Ktt / np.sqrt(np.diag(Db))
+
+def blochmessiah(S):
+    N, _ = S.shape
+
+    # Changing Basis
+    R = (1 / np.sqrt(2)) * np.block(
+        [[np.eye(N // 2), 1j * np.eye(N // 2)], [np.eye(N // 2), -1j * np.eye(N // 2)]]
+    )
+    Sc = R @ S @ np.conjugate(R).T
+    # Polar Decomposition
+    # u1, d1, v1 = np.linalg.svd(Sc)
+    u1, d1, v1 = svd(Sc, lapack_driver='gesvd')
+    Sig = u1 @ np.diag(d1) @ np.conjugate(u1).T
+    Unitary = u1 @ v1
+    # Blocks of Unitary and Hermitian symplectics
+    alpha = Unitary[0 : N // 2, 0 : N // 2]
+    beta = Sig[0 : N // 2, N // 2 : N]
+    # Bloch-Messiah in this Basis
+    u2, d2, v2 = np.linalg.svd(beta)
+    sval = np.arcsinh(d2)
+    takagibeta = u2 @ sqrtm(np.conjugate(u2).T @ (v2.T))
+    uf = np.block([[takagibeta, 0 * takagibeta], [0 * takagibeta, np.conjugate(takagibeta)]])
+    vf = np.block(
+        [
+            [np.conjugate(takagibeta).T @ alpha, 0 * takagibeta],
+            [0 * takagibeta, np.conjugate(np.conjugate(takagibeta).T @ alpha)],
+        ]
+    )
+    df = np.block(
+        [
+            [np.diag(np.cosh(sval)), np.diag(np.sinh(sval))],
+            [np.diag(np.sinh(sval)), np.diag(np.cosh(sval))],
+        ]
+    )
+    # Rotating Back to Original Basis
+    uff = np.conjugate(R).T @ uf @ R
+    vff = np.conjugate(R).T @ vf @ R
+    dff = np.conjugate(R).T @ df @ R
+    dff = np.real_if_close(dff)
+    vff = np.real_if_close(vff)
+    uff = np.real_if_close(uff)
+    return uff, dff, vff
+
+def matrix_hash(name, matrix):
+    matrix = np.ascontiguousarray(matrix)
+    h = hashlib.sha256(name.encode())
+    h.update(str(matrix.dtype).encode())
+    h.update(str(matrix.shape).encode())
+    h.update(matrix.tobytes())
+    return h.hexdigest()
+
+def cached_call(name, function, matrix, cache_dir):
+    if cache_dir is None:
+        return function(matrix)
+    file = cache_dir + f'{name}_{matrix_hash(name, matrix)}.npz'
+    if os.path.isfile(file):
+        with np.load(file) as data:
+            return tuple(data[f'arr_{i}'] for i in range(len(data.files)))
+    results = function(matrix)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so that concurrent ranks never read a partial file
+    temp_file = file + f'.{os.getpid()}.tmp'
+    with open(temp_file, 'wb') as f:
+        np.savez(f, *results)
+    os.replace(temp_file, file)
+    return results
+
+def cached_williamson(V, cache_dir=None):
+    return cached_call('williamson', williamson, V, cache_dir)
+
+def cached_blochmessiah(S, cache_dir=None):
+    return cached_call('blochmessiah', blochmessiah, S, cache_dir)
+
+def get_cache_dir(rootdir):
+    return rootdir + 'symplectic_cache/'
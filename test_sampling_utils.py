@@ -0,0 +1,30 @@
+import numpy as np
+from sampling_utils import sampling, displacement_tails, batch_displaces
+
+# Product MPS of vacuum modes: every site has a single Schmidt index and no photons before the displacement
+def vacuum_mps(M, chi, d):
+    Gammas = []
+    for i in range(M):
+        Gamma = np.zeros([chi, chi, d], dtype='complex64')
+        Gamma[0, 0, 0] = 1
+        Gammas.append(Gamma)
+    Lambda = np.zeros([chi, M - 1], dtype='float32')
+    Lambda[0] = 1
+    return Gammas, Lambda
+
+# Near-vacuum modes get adaptive cutoffs below d, which need c x d displacement blocks
+def test_adaptive_cutoffs_below_d():
+    M, chi, d, dd = 3, 2, 3, 6
+    Gammas, Lambda = vacuum_mps(M, chi, d)
+    samples = sampling(Gammas, dd, Lambda, 0.01 * np.eye(2 * M), 50, np.random.default_rng(0), eps=1e-3)
+    assert samples.shape == (50, M)
+    assert (samples == 0).all()
+
+# The tail at any radius inside a grid cell is bounded by the entry at the end of the cell
+def test_displacement_tails_bound_whole_cell():
+    d, dd = 3, 6
+    radii, tails = displacement_tails(d, dd, grid_size=64)
+    fine_radii = np.linspace(0, radii[-1], 20000)
+    D = batch_displaces(dd, fine_radii, dtype='complex128')
+    fine_tails = np.maximum(1 - np.cumsum(np.abs(D[:, :, :d]) ** 2, axis=1), 0)
+    assert (fine_tails <= tails[np.searchsorted(radii, fine_radii)] + 1e-12).all()